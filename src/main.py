@@ -1,9 +1,13 @@
 from datetime import datetime
 import logging
-import time
 
 import cflib.crtp  # noqa
-from rembuilder.drone import ScanningDrone
+from rembuilder.adaptive import load_measurements, plan_adaptive_drones
+from rembuilder.aggregate import VoxelAggregator
+from rembuilder.fleet import FleetRunner
+from rembuilder.live import LiveServer
+from rembuilder.metrics import MetricsServer
+from rembuilder.planner import plan_drones
 
 logging.getLogger("cflib").setLevel(logging.ERROR)
 logger = logging.getLogger("rembuilder")
@@ -28,6 +32,39 @@ logger.addHandler(fhi)
 # x: 0m -> 3.74m
 # y: 0m -> 2.30m
 # z: 0m -> 2,10m
+VOLUME = ((0.0, 3.74), (0.0, 2.30), (0.0, 2.10))
+
+# Replace the hand written sequences below by a planned grid with this spacing (in meters)
+USE_PLANNER = False
+PLANNER_RESOLUTION = 0.5
+
+# "hover" scans while hovering at every waypoint with a scan, "continuous" flies the waypoints of every drone as one
+# path while the ESP8266 scans periodically (the scan flags are ignored). A drone can override this with a "mode" of its
+# own.
+MISSION_MODE = "hover"
+
+# After the first pass, fly a second one of at most this many seconds per drone that scans where the map built from
+# the first pass is most uncertain (None to disable). Plan the first pass coarse (e.g. USE_PLANNER with a resolution
+# of 0.75) to leave the detail to this pass.
+ADAPTIVE_BUDGET = None
+
+# Output files: scans are written and flushed in batches of WRITER_BATCH_SCANS, with WRITER_FSYNC every batch is also
+# forced to disk (a crash loses at most one batch), files are rotated once they grow beyond WRITER_MAX_FILE_SIZE bytes
+WRITER_BATCH_SCANS = 1
+WRITER_FSYNC = False
+WRITER_MAX_FILE_SIZE = 64 * 1024 * 1024
+
+# Save the progress of every drone after each waypoint, with RESUME set the waypoints already scanned are skipped
+CHECKPOINT_DIR = "output/checkpoints"
+RESUME = False
+
+# Follow the mission on http://127.0.0.1:<port>/events (server-sent events), None to disable
+LIVE_PORT = None
+
+# Timing of every mission phase (connect, estimator, transit, scans, radio silence, ...) is written to METRICS_FILE at
+# the end, and served on http://127.0.0.1:<port>/metrics for Prometheus during the mission unless METRICS_PORT is None
+METRICS_FILE = "output/" + datetime.now().strftime('%Y%m%d_%H%M%S') + "_rembuilder_metrics.json"
+METRICS_PORT = None
 
 # TEST SEQUENCE
 # drones = [
@@ -176,20 +213,37 @@ if __name__ == '__main__':
     # Initialize the low-level drivers (don't list the debug drivers)
     cflib.crtp.init_drivers(enable_debug_driver=False)
 
-    # Initialize drones
-    for drone in drones:
-        scanning_drone = ScanningDrone(
-            drone["uri"],
-            drone["start_x"],
-            drone["start_y"],
-            drone["start_z"],
-            drone["start_yaw"]
-        )
-
-        # drone.dry_run = True
-        while not scanning_drone.is_connected:
-            time.sleep(0.1)
-
-        scanning_drone.initialize()
-        scanning_drone.scan_waypoints(drone["sequence"])
-        scanning_drone.shutdown()
+    if USE_PLANNER:
+        plan_drones(drones, VOLUME, PLANNER_RESOLUTION)
+
+    live = None
+    aggregator = None
+    if LIVE_PORT is not None:
+        aggregator = VoxelAggregator()
+        live = LiveServer(LIVE_PORT, aggregator)
+        live.start()
+
+    metrics_server = None
+    if METRICS_PORT is not None:
+        metrics_server = MetricsServer(METRICS_PORT)
+        metrics_server.start()
+
+    # Connect, initialize and fly all drones at the same time
+    try:
+        runs = FleetRunner(drones, dry_run=False, aggregator=aggregator, live=live, checkpoint_dir=CHECKPOINT_DIR,
+                           resume=RESUME, metrics_file=METRICS_FILE, mode=MISSION_MODE, batch_scans=WRITER_BATCH_SCANS,
+                           fsync=WRITER_FSYNC, max_file_size=WRITER_MAX_FILE_SIZE).run()
+        if ADAPTIVE_BUDGET is not None:
+            filenames = [f for run in runs if run.drone is not None and run.drone.writer is not None
+                         for f in run.drone.writer.filenames]
+            plan_adaptive_drones(drones, load_measurements(filenames), VOLUME, ADAPTIVE_BUDGET)
+            # The drones are powered down after every pass
+            input("Switch the drones on again (fresh batteries) and press enter to fly the adaptive pass...")
+            FleetRunner(drones, dry_run=False, aggregator=aggregator, live=live, metrics_file=METRICS_FILE,
+                        mode=MISSION_MODE, batch_scans=WRITER_BATCH_SCANS, fsync=WRITER_FSYNC,
+                        max_file_size=WRITER_MAX_FILE_SIZE).run()
+    finally:
+        if live is not None:
+            live.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
@@ -0,0 +1,210 @@
+import argparse
+import json
+import logging
+import math
+
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .planner import WALL_MARGIN, Point, StartPose, Waypoint, grid_points, plan_route
+from .rem import Volume, as_store, fit_variogram, idw_weights, kriging_weights, scan_table
+from .store import MeasurementStore
+from .utils import Measurement
+
+logger = logging.getLogger("rembuilder")
+
+CANDIDATE_RESOLUTION = 0.25  # Spacing in meters of the grid the new scan positions are picked from
+MIN_SPACING = 0.2  # Candidates closer than this (in meters) to a scan position of the earlier passes are skipped
+NEIGHBOURS = 8  # Number of scan positions the uncertainty at a candidate is estimated from
+CANDIDATE_CHUNK = 4096  # Candidates per batch when comparing the neighbouring readings
+TRANSIT_SPEED = 0.5  # Average speed in meters per second between waypoints, for estimating the flight time
+SETTLE_TIME = 0.6  # Number of seconds per waypoint to slow down and settle on it
+SCAN_TIME = 3.5  # Number of seconds per scan, including the radio silence and reconnecting
+
+Measurements = Union[MeasurementStore, Iterable[Measurement]]
+
+
+def load_measurements(filenames: Sequence[str]) -> MeasurementStore:
+    # All *_rembuilder.out files of the earlier passes in one store
+    store = MeasurementStore()
+    for filename in filenames:
+        store.extend(MeasurementStore.load(filename))
+    return store
+
+
+def flight_time(waypoints: Sequence[Waypoint]) -> float:
+    # Rough duration in seconds of flying a waypoint sequence (relative to the start), from its length and the
+    # number of waypoints and scans
+    seconds = 0.0
+    previous = (0.0, 0.0, 0.0)
+    for waypoint in waypoints:
+        seconds += math.dist(previous, waypoint[:3]) / TRANSIT_SPEED + SETTLE_TIME
+        if waypoint[4]:
+            seconds += SCAN_TIME
+        previous = waypoint[:3]
+    return seconds
+
+
+def uncertainty(measurements: Measurements, candidates: np.ndarray, k: int = NEIGHBOURS,
+                variogram: Optional[Tuple[float, float, float]] = None):
+    # Expected squared interpolation error (in normalized signal strength, per access point) at every candidate
+    # position. Two estimates are added up:
+    # - the kriging variance, which only depends on how far the candidate is from the scan positions
+    # - how much the readings at the neighbouring scan positions disagree, which is high where the signal changes
+    #   quickly (walls, close to an access point) and low where the field is smooth
+    # Returns (uncertainty, kriging variance, disagreement, variogram).
+    positions, values, observed, _ = scan_table(as_store(measurements))
+    if len(positions) == 0:
+        raise ValueError("No measurements to estimate the uncertainty from")
+    if variogram is None:
+        variogram = fit_variogram(positions, values, observed)
+
+    k = min(k, len(positions))
+    distances, neighbours = cKDTree(positions).query(candidates, k=k)
+    distances = distances.reshape(len(candidates), k)
+    neighbours = neighbours.reshape(len(candidates), k)
+    _, variance = kriging_weights(positions, distances, neighbours, variogram)
+
+    # IDW weighted variance of the neighbouring readings around their weighted mean, averaged over the access points
+    weights = idw_weights(distances, 2.0)
+    disagreement = np.empty(len(candidates))
+    for start in range(0, len(candidates), CANDIDATE_CHUNK):
+        stop = min(start + CANDIDATE_CHUNK, len(candidates))
+        local = values[neighbours[start:stop]]
+        mean = np.einsum('nk,nka->na', weights[start:stop], local)
+        spread = np.einsum('nk,nka->n', weights[start:stop], (local - mean[:, None, :]) ** 2)
+        disagreement[start:stop] = spread / max(values.shape[1], 1)
+
+    return variance + disagreement, variance, disagreement, variogram
+
+
+def _insertion(tour: List[Point], point: Point) -> Tuple[float, int]:
+    # Cheapest place to insert point into the closed tour, as (extra meters, index)
+    best = None
+    for i in range(len(tour) - 1):
+        extra = math.dist(tour[i], point) + math.dist(point, tour[i + 1]) - math.dist(tour[i], tour[i + 1])
+        if best is None or extra < best[0]:
+            best = (extra, i + 1)
+    return best
+
+
+def select_points(candidates: np.ndarray, scores: np.ndarray, variogram: Tuple[float, float, float],
+                  starts: List[StartPose], budget: float, min_score: float = 0.0) -> List[List[Tuple[Point, float]]]:
+    # Greedily picks the candidate with the highest expected error reduction and gives it to the drone that can add
+    # it to its tour at the lowest cost within budget seconds. A scan also lowers the uncertainty around it, the
+    # scores of the other candidates are scaled by 1 - correlation^2 with the picked position (the variance left
+    # after a single observation under the variogram). Returns (point, score) per drone.
+    nugget, psill, range_ = variogram
+    scores = np.array(scores, dtype=np.float64)
+    tours = [[start[:3], start[:3]] for start in starts]
+    times = [0.0 for _ in starts]
+    picked: List[List[Tuple[Point, float]]] = [[] for _ in starts]
+    # Candidates are taken out with a mask, not by setting their score to -inf: with a zero nugget the correlation of
+    # a picked candidate with itself is 1, and scaling -inf by 0 would give NaN
+    available = np.ones(len(scores), dtype=bool)
+
+    while available.any():
+        best = int(np.argmax(np.where(available, scores, -np.inf)))
+        score = scores[best]
+        if not score > min_score:
+            break
+        point = tuple(float(c) for c in candidates[best])
+        available[best] = False
+
+        options = []
+        for drone, tour in enumerate(tours):
+            extra, index = _insertion(tour, point)
+            cost = extra / TRANSIT_SPEED + SETTLE_TIME + SCAN_TIME
+            if times[drone] + cost <= budget:
+                options.append((cost, drone, index))
+        if not options:
+            continue
+        cost, drone, index = min(options)
+        tours[drone].insert(index, point)
+        times[drone] += cost
+        picked[drone].append((point, float(score)))
+
+        distance = np.linalg.norm(candidates - candidates[best], axis=1)
+        correlation = psill * np.exp(-3.0 * distance / range_) / max(nugget + psill, 1e-12)
+        scores *= 1.0 - correlation ** 2
+
+    return picked
+
+
+def plan_adaptive(measurements: Measurements, volume: Volume, starts: List[StartPose], budget: float,
+                  resolution: Union[float, Sequence[float]] = CANDIDATE_RESOLUTION, margin: float = WALL_MARGIN,
+                  min_spacing: float = MIN_SPACING, k: int = NEIGHBOURS) -> List[List[Waypoint]]:
+    # One waypoint sequence per start pose for the next pass, with the scans where the map built from the
+    # measurements so far is most uncertain. Every sequence is planned to take at most budget seconds of flight.
+    store = as_store(measurements)
+    positions = scan_table(store)[0]
+    candidates = np.array(grid_points(volume, resolution, margin), dtype=np.float64)
+    if len(positions):
+        candidates = candidates[cKDTree(positions).query(candidates)[0] >= min_spacing]
+    if len(candidates) == 0:
+        return [[] for _ in starts]
+
+    scores, variance, disagreement, variogram = uncertainty(store, candidates, k, None)
+    logger.info(f"Uncertainty over {len(candidates)} candidates: mean {scores.mean():.4f}, max {scores.max():.4f} "
+                f"(kriging {variance.mean():.4f}, disagreement {disagreement.mean():.4f})")
+
+    sequences = []
+    for start, picked in zip(starts, select_points(candidates, scores, variogram, starts, budget)):
+        # plan_route orders the layers differently from the insertion tour, drop the least useful scans until the
+        # route fits the budget again
+        picked.sort(key=lambda pick: pick[1], reverse=True)
+        waypoints = plan_route(start, [point for point, _ in picked])
+        while picked and flight_time(waypoints) > budget:
+            picked.pop()
+            waypoints = plan_route(start, [point for point, _ in picked])
+        sequences.append(waypoints)
+    return sequences
+
+
+def plan_adaptive_drones(drones: List[dict], measurements: Measurements, volume: Volume, budget: float,
+                         resolution: Union[float, Sequence[float]] = CANDIDATE_RESOLUTION,
+                         margin: float = WALL_MARGIN) -> List[dict]:
+    # Fills in the "sequence" of drone configurations in the format used in main.py, like planner.plan_drones
+    starts = [(d["start_x"], d["start_y"], d["start_z"], d["start_yaw"]) for d in drones]
+    for drone, sequence in zip(drones, plan_adaptive(measurements, volume, starts, budget, resolution, margin)):
+        drone["sequence"] = sequence
+        logger.info(f"{drone['uri']}: {sum(1 for w in sequence if w[4])} adaptive scan positions planned, "
+                    f"about {flight_time(sequence):.0f}s of flight")
+    return drones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plan the next scan positions where the radio environment map "
+                                                 "built from earlier measurements is most uncertain")
+    parser.add_argument('files', nargs='+', help="*_rembuilder.out measurement files of the earlier passes")
+    parser.add_argument('--volume', type=float, nargs=6, required=True,
+                        metavar=('X0', 'X1', 'Y0', 'Y1', 'Z0', 'Z1'), help="flight volume in meters")
+    parser.add_argument('--start', type=float, nargs=4, action='append', required=True,
+                        metavar=('X', 'Y', 'Z', 'YAW'), help="start pose of a drone (repeat for every drone)")
+    parser.add_argument('--budget', type=float, default=120.0, help="flight time per drone in seconds")
+    parser.add_argument('--resolution', type=float, default=CANDIDATE_RESOLUTION,
+                        help="spacing in meters of the candidate scan positions")
+    parser.add_argument('--output', default=None, help="write the waypoint sequences (JSON) to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.INFO)
+
+    volume = tuple(zip(args.volume[0::2], args.volume[1::2]))
+    starts = [tuple(start) for start in args.start]
+    sequences = plan_adaptive(load_measurements(args.files), volume, starts, args.budget, args.resolution)
+    for start, sequence in zip(starts, sequences):
+        logger.info(f"Start {start}: {sum(1 for w in sequence if w[4])} scans, about {flight_time(sequence):.0f}s")
+
+    text = json.dumps([[list(waypoint) for waypoint in sequence] for sequence in sequences], indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            fh.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import logging
+import math
+
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .utils import Measurement
+
+logger = logging.getLogger("rembuilder")
+
+Voxel = Tuple[int, int, int]
+
+VOXEL_SIZE = 0.25  # Edge length in meters of the voxels measurements are aggregated in
+
+
+class RunningStats:
+    # Count, mean, variance (Welford's online algorithm), min and max of a stream of values in constant memory
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def copy(self) -> 'RunningStats':
+        stats = RunningStats()
+        stats.count, stats.mean, stats.m2, stats.min, stats.max = self.count, self.mean, self.m2, self.min, self.max
+        return stats
+
+    def merge(self, other: 'RunningStats'):
+        # Chan et al.'s parallel variant, e.g. to combine the aggregators of several missions
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> float:
+        # Sample variance, 0 until there are two values
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    def __repr__(self):
+        return f"RunningStats(count={self.count}, mean={self.mean:.2f}, std={self.std:.2f}, min={self.min}, " \
+               f"max={self.max})"
+
+
+# RSSI statistics per (voxel, MAC), updated as scans come in. Memory grows with the number of distinct voxels and
+# access points, not with the number of scans, so a drone can aggregate a long mission without keeping any rows.
+# Register append_scan as a ConsolePrinter scan listener (ScanningDrone does so when given an aggregator); scans of
+# several drones may be added from their own threads. After every scan the listeners get a copy of the statistics of
+# the cells it changed, as (voxel, MAC, statistics).
+class VoxelAggregator:
+    def __init__(self, voxel_size: float = VOXEL_SIZE):
+        self.voxel_size = voxel_size
+        self.cells: Dict[Voxel, Dict[str, RunningStats]] = {}
+        self.cell_count = 0  # Number of (voxel, MAC) pairs
+        self.measurement_count = 0
+        self.scan_count = 0
+        self.listeners: List[Callable[[List[Tuple[Voxel, str, RunningStats]]], None]] = []
+        self._lock = Lock()
+
+    def voxel_of(self, x: float, y: float, z: float) -> Voxel:
+        size = self.voxel_size
+        return math.floor(x / size), math.floor(y / size), math.floor(z / size)
+
+    def voxel_center(self, voxel: Voxel) -> Tuple[float, float, float]:
+        return tuple((index + 0.5) * self.voxel_size for index in voxel)
+
+    def _stats(self, voxel: Voxel, mac: str) -> RunningStats:
+        macs = self.cells.get(voxel)
+        if macs is None:
+            macs = self.cells[voxel] = {}
+        stats = macs.get(mac)
+        if stats is None:
+            stats = macs[mac] = RunningStats()
+            self.cell_count += 1
+        return stats
+
+    def _add(self, measurement: Measurement) -> Tuple[Voxel, str]:
+        voxel = self.voxel_of(measurement.x, measurement.y, measurement.z)
+        self._stats(voxel, measurement.mac).add(measurement.rssi)
+        return voxel, measurement.mac
+
+    def add(self, measurement: Measurement):
+        with self._lock:
+            self._add(measurement)
+            self.measurement_count += 1
+
+    def append_scan(self, scan: Iterable[Measurement]):
+        with self._lock:
+            changed = set()
+            count = 0
+            for measurement in scan:
+                changed.add(self._add(measurement))
+                count += 1
+            self.measurement_count += count
+            self.scan_count += 1
+            if self.listeners:
+                changed = [(voxel, mac, self.cells[voxel][mac].copy()) for voxel, mac in changed]
+
+        for listener in self.listeners:
+            try:
+                listener(changed)
+            except Exception:
+                logger.exception("Aggregator listener failed")
+
+    def stats(self, voxel: Voxel, mac: str) -> Optional[RunningStats]:
+        return self.cells.get(tuple(voxel), {}).get(str(mac).rjust(12, '0'))
+
+    def at(self, x: float, y: float, z: float) -> Dict[str, RunningStats]:
+        # Statistics of every access point heard in the voxel containing (x, y, z)
+        with self._lock:
+            return dict(self.cells.get(self.voxel_of(x, y, z), {}))
+
+    def voxels(self) -> List[Voxel]:
+        with self._lock:
+            return sorted(self.cells)
+
+    def macs(self) -> List[str]:
+        with self._lock:
+            return sorted({mac for macs in self.cells.values() for mac in macs})
+
+    def __len__(self):
+        return self.cell_count
+
+    def snapshot(self) -> List[Tuple[Voxel, str, RunningStats]]:
+        # A consistent copy of all cells as (voxel, MAC, statistics)
+        with self._lock:
+            return [(voxel, mac, stats.copy()) for voxel, macs in self.cells.items() for mac, stats in macs.items()]
+
+    def rows(self) -> Iterator[Tuple[Tuple[float, float, float], str, RunningStats]]:
+        # (voxel center, MAC, statistics) per cell
+        for voxel, mac, stats in self.snapshot():
+            yield self.voxel_center(voxel), mac, stats
+
+    def merge(self, other: 'VoxelAggregator'):
+        if other.voxel_size != self.voxel_size:
+            raise ValueError("Aggregators with different voxel sizes cannot be merged")
+        with self._lock:
+            for voxel, macs in other.cells.items():
+                for mac, stats in macs.items():
+                    self._stats(voxel, mac).merge(stats)
+            self.measurement_count += other.measurement_count
+            self.scan_count += other.scan_count
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+
+from typing import Optional
+
+import cflib.crtp  # noqa
+from cflib.crazyflie import Crazyflie
+from cflib.crazyflie.log import LogConfig
+from cflib.crazyflie.toccache import TocCache
+from cflib.utils.power_switch import PowerSwitch
+
+from .clock import SYSTEM_CLOCK
+
+logger = logging.getLogger("rembuilder")
+
+CACHE_DIR = './cache'  # cflib keeps the log and param TOCs it downloaded here, as <crc>.json
+
+
+class _RecordingTocCache(TocCache):
+    # Counts the TOCs of one Crazyflie that were (not) found in the cache. The cache directory is shared by every drone
+    # of a fleet, so new files in it do not tell which drone had to download its TOC.
+    def __init__(self, ro_cache=None, rw_cache=None):
+        super().__init__(ro_cache=ro_cache, rw_cache=rw_cache)
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, crc):
+        toc = super().fetch(crc)
+        if toc is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return toc
+
+
+# Everything ScanningDrone needs from cflib, so a simulated Crazyflie (see sim.py) can take its place
+class CflibBackend:
+    clock = SYSTEM_CLOCK
+
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def create_crazyflie(self):
+        cf = Crazyflie(rw_cache=self.cache_dir)
+        # cflib has no public way to tell whether the TOCs came from the cache, its cache is replaced by one that
+        # keeps count
+        cf._toc_cache = _RecordingTocCache(rw_cache=self.cache_dir)
+        return cf
+
+    def toc_cache_hit(self, cf) -> Optional[bool]:
+        # Whether all TOCs of cf were found in the cache, None when unknown (e.g. before connecting)
+        cache = getattr(cf, '_toc_cache', None)
+        if not isinstance(cache, _RecordingTocCache) or cache.hits + cache.misses == 0:
+            return None
+        return cache.misses == 0
+
+    def cache_files(self) -> set:
+        if not os.path.isdir(self.cache_dir):
+            return set()
+        return {name for name in os.listdir(self.cache_dir) if name.endswith('.json')}
+
+    def prepare_cache(self) -> dict:
+        # Reads every cached TOC once: a truncated file (e.g. from a crash while writing it) would make cflib fail
+        # the connection, so it is removed and downloaded again. Reading them also brings them into the OS page
+        # cache before all drones connect at once.
+        valid, removed = 0, 0
+        for name in sorted(self.cache_files()):
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                with open(filename) as fh:
+                    json.load(fh)
+                valid += 1
+            except (OSError, ValueError) as e:
+                logger.warning(f"Removing invalid TOC cache file {filename}: {e}")
+                os.remove(filename)
+                removed += 1
+        return {'valid': valid, 'removed': removed}
+
+    def log_config(self, name: str, period_in_ms: int):
+        return LogConfig(name=name, period_in_ms=period_in_ms)
+
+    def close_link_driver(self, link_uri: str):
+        cflib.crtp.get_link_driver(link_uri).close()
+
+    def power_down(self, link_uri: str):
+        PowerSwitch(link_uri).platform_power_down()
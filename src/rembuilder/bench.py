@@ -0,0 +1,157 @@
+import argparse
+import logging
+import random
+import time
+
+from typing import List, Optional, Sequence, Tuple
+
+from .replay import ReplayConsole, ReplayDriver, read_console_lines, split_consoles
+from .utils import ConsolePrinter
+
+logger = logging.getLogger("rembuilder")
+
+
+class TimedConsolePrinter(ConsolePrinter):
+    # Records when every line gets parsed, to measure the latency between receiving and parsing a line
+    def __init__(self, console, sink=None):
+        super().__init__(console, sink)
+        self.line_parsed_times: List[float] = []
+
+    def parse_line(self, line):
+        super().parse_line(line)
+        self.line_parsed_times.append(time.perf_counter())
+
+
+def synthetic_console(scans: int = 1000, aps_per_scan: int = 30, noise_lines: int = 5,
+                      seed: int = 0) -> List[Tuple[None, str]]:
+    # Console output shaped like the ESP8266 deck firmware's, with some unrelated lines in between scans
+    rng = random.Random(seed)
+    macs = [f"{rng.getrandbits(48):012x}" for _ in range(aps_per_scan * 4)]
+    lines = []
+    for scan in range(scans):
+        lines.extend(f"DBG: unrelated firmware output {scan} {i}" for i in range(noise_lines))
+        lines.append("AT+CWLAP")
+        lines.append(f"POS: x={rng.uniform(0, 3.74):.6f} y={rng.uniform(0, 2.3):.6f} z={rng.uniform(0, 2.1):.6f}")
+        lines.append("ESP8266: -- START READING --")
+        for mac in rng.sample(macs, aps_per_scan):
+            lines.append(f"AP: net-{mac[-4:]}, {rng.randint(-95, -30)}, {mac}, {rng.randint(1, 13)}")
+        lines.append("ESP8266: -- STOP READING --")
+    return [(None, line) for line in lines]
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    # values must be sorted
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class MeasurementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def write_scan(self, measurements):
+        self.count += len(measurements)
+
+    def close(self):
+        pass
+
+
+def bench_ingestion(lines, speed: Optional[float] = None) -> dict:
+    # Full path: console callbacks -> ConsolePrinter thread -> parser -> scan listeners
+    console = ReplayConsole()
+    counter = MeasurementCounter()
+    printer = TimedConsolePrinter(console, sink=counter)
+    driver = ReplayDriver(console, lines, speed)
+    driver.record_times = True
+
+    printer.start()
+    started = time.perf_counter()
+    driver.run()
+    printer.stop = True
+    printer.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(parsed - sent for sent, parsed in zip(driver.line_sent_times, printer.line_parsed_times))
+    return {
+        'lines': driver.lines_sent,
+        'elapsed': elapsed,
+        'lines_per_second': driver.lines_sent / elapsed,
+        'chars_per_second': driver.chars_sent / elapsed,
+        'measurements': counter.count,
+        'measurements_per_second': counter.count / elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': latencies[-1] if latencies else 0.0,
+    }
+
+
+def bench_parse(lines) -> dict:
+    # Parser only, without threads or the console buffer
+    counter = MeasurementCounter()
+    printer = ConsolePrinter(ReplayConsole(), sink=counter)
+    texts = [line for _, line in lines]
+
+    started = time.perf_counter()
+    for line in texts:
+        printer.parse_line(line)
+    elapsed = time.perf_counter() - started
+    return {
+        'lines': len(texts),
+        'elapsed': elapsed,
+        'lines_per_second': len(texts) / elapsed,
+        'measurements': counter.count,
+        'measurements_per_second': counter.count / elapsed,
+    }
+
+
+def bench(lines, speed: Optional[float] = None):
+    ingestion = bench_ingestion(lines, speed)
+    parsing = bench_parse(lines)
+
+    print(f"Ingestion: {ingestion['lines']} lines in {ingestion['elapsed']:.3f}s, "
+          f"{ingestion['lines_per_second']:.0f} lines/s, {ingestion['chars_per_second'] / 1e6:.2f} MB/s, "
+          f"{ingestion['measurements_per_second']:.0f} measurements/s")
+    print(f"Latency:   p50 {ingestion['latency_p50'] * 1e3:.2f}ms, p90 {ingestion['latency_p90'] * 1e3:.2f}ms, "
+          f"p99 {ingestion['latency_p99'] * 1e3:.2f}ms, max {ingestion['latency_max'] * 1e3:.2f}ms")
+    print(f"Parsing:   {parsing['lines']} lines in {parsing['elapsed']:.3f}s, {parsing['lines_per_second']:.0f} "
+          f"lines/s, {parsing['measurements_per_second']:.0f} measurements/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay console recordings through ConsolePrinter and report "
+                                                 "ingestion and parsing performance")
+    parser.add_argument('files', nargs='*', help="*_console_debug.out files or raw console dumps to replay, a "
+                                                 "synthetic recording is used when none are given")
+    parser.add_argument('--speed', type=float, default=None,
+                        help="replay at this multiple of the recorded speed (1 = real-time), default is unthrottled")
+    parser.add_argument('--scans', type=int, default=2000, help="number of scans in the synthetic recording")
+    parser.add_argument('--aps', type=int, default=30, help="access points per scan in the synthetic recording")
+    parser.add_argument('--drone', default=None, metavar='TAG',
+                        help="replay only the console of this drone (e.g. 0_80_2M_E7E7E7E7E7), by default the console "
+                             "of every drone in the recordings is replayed separately")
+    args = parser.parse_args(argv)
+
+    # Keep the per-line logging of ConsolePrinter out of the measurement
+    logger.setLevel(logging.WARNING)
+
+    # The recording of a fleet interleaves the consoles of its drones, every console goes through its own printer
+    consoles = {}
+    if args.drone is not None:
+        consoles[args.drone] = [entry for filename in args.files for entry in read_console_lines(filename, args.drone)]
+    elif args.files:
+        for filename in args.files:
+            for tag, lines in split_consoles(filename).items():
+                consoles.setdefault(tag, []).extend(lines)
+    else:
+        consoles[None] = synthetic_console(args.scans, args.aps)
+
+    for tag, lines in consoles.items():
+        if tag is not None:
+            print(f"Drone {tag}:")
+        bench(lines, args.speed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+
+from typing import List, Sequence
+
+logger = logging.getLogger("rembuilder")
+
+
+def sequence_hash(waypoints: Sequence[Sequence]) -> str:
+    # Identifies a waypoint sequence, a checkpoint is only resumed for the sequence it was written for
+    return hashlib.sha1(json.dumps([list(w) for w in waypoints]).encode()).hexdigest()
+
+
+def checkpoint_filename(directory: str, tag: str) -> str:
+    return os.path.join(directory, f"{tag}_checkpoint.json")
+
+
+# Progress of one drone through its waypoint sequence, written after every waypoint. The file is replaced atomically
+# (write, fsync, rename), so after a crash it holds either the previous or the new state, never a partial one.
+class MissionCheckpoint:
+    def __init__(self, filename: str, link: str, waypoints: Sequence[Sequence]):
+        self.filename = filename
+        self.link = link
+        self.sequence = sequence_hash(waypoints)
+        self.waypoint_count = len(waypoints)
+        self.next_waypoint = 0
+        self.scanned: List[int] = []  # Indices of the waypoints with a completed scan
+        self.scans = 0
+        self.measurements = 0
+        self.output: List[str] = []
+        self.estimator = {}
+        self.done = False
+        self.updated = None
+
+    def to_dict(self) -> dict:
+        return {
+            'link': self.link,
+            'sequence': self.sequence,
+            'waypoint_count': self.waypoint_count,
+            'next_waypoint': self.next_waypoint,
+            'scanned': self.scanned,
+            'scans': self.scans,
+            'measurements': self.measurements,
+            'output': self.output,
+            'estimator': self.estimator,
+            'done': self.done,
+            'updated': self.updated,
+        }
+
+    def save(self):
+        self.updated = datetime.utcnow().isoformat()
+        temporary = self.filename + ".tmp"
+        with open(temporary, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=2)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temporary, self.filename)
+
+    @classmethod
+    def load(cls, filename: str, link: str, waypoints: Sequence[Sequence]) -> 'MissionCheckpoint':
+        # The saved progress if it belongs to this drone and sequence, otherwise a fresh checkpoint
+        checkpoint = cls(filename, link, waypoints)
+        if not os.path.exists(filename):
+            return checkpoint
+
+        try:
+            with open(filename) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError) as e:
+            logger.warning(f"{link}: ignoring unreadable checkpoint {filename}: {e}")
+            return checkpoint
+
+        if data.get('link') != link or data.get('sequence') != checkpoint.sequence:
+            logger.warning(f"{link}: checkpoint {filename} is for another drone or waypoint sequence, starting over")
+            return checkpoint
+
+        checkpoint.next_waypoint = data['next_waypoint']
+        checkpoint.scanned = list(data['scanned'])
+        checkpoint.scans = data['scans']
+        checkpoint.measurements = data['measurements']
+        checkpoint.output = list(data['output'])
+        checkpoint.estimator = data['estimator']
+        checkpoint.done = data['done']
+        checkpoint.updated = data['updated']
+        return checkpoint
+
+    def is_scanned(self, index: int) -> bool:
+        return index in self.scanned
@@ -0,0 +1,44 @@
+import time
+
+from threading import Event, Timer
+from typing import Callable, Optional
+
+
+# Source of (monotonic) time for everything that waits on the drone. The system clock is the real thing, a scaled
+# clock runs speed times faster so missions against a simulated Crazyflie finish quickly.
+class SystemClock:
+    speed = 1.0
+
+    def time(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def wait(self, event: Event, timeout: Optional[float] = None) -> bool:
+        return event.wait(timeout)
+
+    def call_later(self, delay: float, function: Callable, *args) -> Timer:
+        timer = Timer(delay / self.speed, function, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class ScaledClock(SystemClock):
+    def __init__(self, speed: float = 100.0):
+        self.speed = speed
+        self._origin = time.monotonic()
+
+    def time(self) -> float:
+        now = time.monotonic()
+        return self._origin + (now - self._origin) * self.speed
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds / self.speed)
+
+    def wait(self, event: Event, timeout: Optional[float] = None) -> bool:
+        return event.wait(None if timeout is None else timeout / self.speed)
+
+
+SYSTEM_CLOCK = SystemClock()
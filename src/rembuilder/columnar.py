@@ -0,0 +1,125 @@
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import time
+
+from typing import List
+
+import numpy as np
+
+from .store import EPOCH, MeasurementStore, StringTable
+
+logger = logging.getLogger("rembuilder")
+
+# Binary columnar layout: a directory with one .npy file per MeasurementStore column and strings.json holding the
+# SSID and MAC tables the ssid/mac columns refer to. The .npy files are memory mapped on loading, so opening a survey
+# costs the same regardless of its size and rows are only read from disk when used.
+FORMAT_VERSION = 1
+STRINGS_FILE = "strings.json"
+COLUMNS_SUFFIX = ".cols"
+DTYPES = {
+    'time': np.int64,
+    'x': np.float64,
+    'y': np.float64,
+    'z': np.float64,
+    'ssid': np.uint32,
+    'rssi': np.int8,
+    'mac': np.uint32,
+    'chn': np.uint8,
+}
+
+
+def save_columns(store: MeasurementStore, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    for name in MeasurementStore.COLUMNS:
+        column = np.frombuffer(getattr(store, name), dtype=DTYPES[name])
+        np.save(os.path.join(directory, name + ".npy"), column)
+    # Written last, a directory without it is an incomplete conversion
+    with open(os.path.join(directory, STRINGS_FILE), 'w') as fh:
+        json.dump({'version': FORMAT_VERSION, 'rows': len(store), 'ssids': store.ssids.strings,
+                   'macs': store.macs.strings}, fh)
+
+
+def _string_table(strings: List[str]) -> StringTable:
+    table = StringTable()
+    table.strings = strings
+    table.ids = {value: string_id for string_id, value in enumerate(strings)}
+    return table
+
+
+# Read-only MeasurementStore on top of memory mapped columns. Everything that reads a store (rows as Measurement
+# objects, rem.build_rem, ...) works unchanged, the columns are numpy arrays instead of array.array.
+class MappedMeasurementStore(MeasurementStore):
+    def __init__(self, directory: str, mmap: bool = True):
+        with open(os.path.join(directory, STRINGS_FILE)) as fh:
+            strings = json.load(fh)
+        if strings.get('version') != FORMAT_VERSION:
+            raise ValueError(f"{directory}: unsupported columnar format version {strings.get('version')}")
+
+        self.directory = directory
+        self.ssids = _string_table(strings['ssids'])
+        self.macs = _string_table(strings['macs'])
+        for name in self.COLUMNS:
+            column = np.load(os.path.join(directory, name + ".npy"), mmap_mode='r' if mmap else None)
+            if len(column) != strings['rows'] or column.dtype != DTYPES[name]:
+                raise ValueError(f"{directory}: column {name} does not match the survey")
+            setattr(self, name, column)
+
+    def append_row(self, *args, **kwargs):
+        raise TypeError("A memory mapped measurement store is read-only")
+
+    def get_timestamp(self, row: int) -> datetime:
+        return EPOCH + timedelta(microseconds=int(self.time[row]))
+
+    def rows_for_mac(self, mac: str) -> List[int]:
+        mac_id = self.macs.ids.get(str(mac).rjust(12, '0'))
+        if mac_id is None:
+            return []
+        return np.flatnonzero(self.mac == mac_id).tolist()
+
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.COLUMNS)
+
+
+def load_columns(directory: str, mmap: bool = True) -> MappedMeasurementStore:
+    return MappedMeasurementStore(directory, mmap)
+
+
+def convert(filenames: List[str], directory: str) -> MeasurementStore:
+    # Converts one or more *_rembuilder.out files (e.g. the rotated parts of one mission) into a single columnar
+    # directory
+    store = MeasurementStore.load(filenames[0])
+    for filename in filenames[1:]:
+        store.extend(MeasurementStore.load(filename))
+    save_columns(store, directory)
+    return store
+
+
+def default_directory(filename: str) -> str:
+    # output/20210501_140312_rembuilder.out -> output/20210501_140312_rembuilder.cols
+    return os.path.splitext(filename)[0] + COLUMNS_SUFFIX
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert *_rembuilder.out measurement files to the binary columnar "
+                                                 "format")
+    parser.add_argument('files', nargs='+', help="measurement files, all of them end up in one columnar directory")
+    parser.add_argument('--output', default=None, help="columnar directory to write, default is next to the first file")
+    args = parser.parse_args(argv)
+
+    directory = args.output if args.output is not None else default_directory(args.files[0])
+    started = time.perf_counter()
+    store = convert(args.files, directory)
+    converted = time.perf_counter() - started
+
+    started = time.perf_counter()
+    mapped = load_columns(directory)
+    loaded = time.perf_counter() - started
+    print(f"Converted {len(store)} measurements ({len(store.macs)} MACs) to {directory} in {converted:.1f}s, "
+          f"{mapped.nbytes() / 1e6:.1f} MB, loads in {loaded * 1e3:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
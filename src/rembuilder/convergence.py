@@ -0,0 +1,69 @@
+from collections import deque
+from threading import Event
+from typing import Dict, Sequence
+
+
+class RollingRange:
+    # Minimum and maximum of the last window values, kept in monotonic deques of (index, value): O(1) amortized per
+    # value and never more than window entries, instead of a list that is shifted and rescanned on every value
+    def __init__(self, window: int):
+        self.window = window
+        self.count = 0
+        self._min = deque()
+        self._max = deque()
+
+    def add(self, value: float):
+        index = self.count
+        self.count += 1
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((index, value))
+        if self._min[0][0] <= index - self.window:
+            self._min.popleft()
+
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((index, value))
+        if self._max[0][0] <= index - self.window:
+            self._max.popleft()
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.window
+
+    @property
+    def min(self) -> float:
+        return self._min[0][1]
+
+    @property
+    def max(self) -> float:
+        return self._max[0][1]
+
+    @property
+    def range(self) -> float:
+        return self._max[0][1] - self._min[0][1]
+
+
+# Decides that a set of logged values (e.g. the Kalman position variances) has converged once each of them varied
+# less than threshold over the last window samples. Feed it from a log callback with add(), converged is set as soon
+# as that happens so a waiting thread can use it with a timeout.
+class ConvergenceDetector:
+    def __init__(self, variables: Sequence[str], window: int = 10, threshold: float = 0.001):
+        self.variables = list(variables)
+        self.threshold = threshold
+        self.ranges: Dict[str, RollingRange] = {variable: RollingRange(window) for variable in self.variables}
+        self.samples = 0
+        self.converged = Event()
+
+    def add(self, data: Dict[str, float]) -> bool:
+        self.samples += 1
+        for variable in self.variables:
+            self.ranges[variable].add(data[variable])
+        if not self.converged.is_set() and all(r.full and r.range < self.threshold for r in self.ranges.values()):
+            self.converged.set()
+        return self.converged.is_set()
+
+    def spread(self) -> Dict[str, float]:
+        # Current max - min per variable, for logging
+        return {variable: r.range for variable, r in self.ranges.items() if r.count}
@@ -1,46 +1,111 @@
 import logging
 import math
-import time
 
-import cflib.crtp  # noqa
-from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.log import LogConfig
-
-# Only output errors from the logger.framework
-from cflib.crazyflie.syncLogger import SyncLogger
-from cflib.utils.power_switch import PowerSwitch
+from threading import Event
 
+from .backend import CflibBackend
+from .convergence import ConvergenceDetector
+from .metrics import METRICS
+from .planner import LANDING_HEIGHT
+from .radio import RadioSilenceScheduler
+from .trajectory import TrajectoryLog
 from .utils import ConsolePrinter
+from .writer import MAX_FILE_SIZE, MeasurementWriter
 
 # Constants
 SCAN_ON_DEMAND = "esp8266.scanOnDemand"
 SCAN_INTERVAL = "esp8266.scanInterval"
 SCAN_NOW = "esp8266.scanNow"
-RADIO_SHUTDOWN_PERIOD = 3  # Number of seconds to shutdown the radio, this should be slightly larger than time to scan
 TIME_TO_WAYPOINT = 3  # Number of seconds allowed to go from 1 waypoint to the next
 ITERATION_FREQUENCY = 0.1  # How often we should send a setpoint in seconds when moving to a waypoint
+POSITION_LOG_PERIOD = 50  # How often the state estimate is logged in milliseconds
+POSITION_TOLERANCE = 0.05  # Distance in meters from a waypoint at which the drone counts as arrived
+VELOCITY_TOLERANCE = 0.1  # Speed in meters per second below which the drone counts as stable
+SETTLING_TIME = 0.3  # Number of seconds the drone has to stay within the tolerances before it has arrived
+POSITION_MAX_AGE = 0.5  # Number of seconds after which a logged position is too old to rely on
+CONNECT_TIMEOUT = 30  # Number of seconds to wait for the link to come up
+PARAM_TIMEOUT = 10  # Number of seconds to wait for a parameter update to be confirmed by the Crazyflie
+SCAN_TIMEOUT = 60  # Number of seconds a scan may take, including the radio shutdown and reconnecting
+ESTIMATOR_LOG_PERIOD = 100  # How often the Kalman variances are logged in milliseconds while waiting for convergence
+ESTIMATOR_WINDOW = 20  # Number of variance samples that have to stay within ESTIMATOR_THRESHOLD
+ESTIMATOR_THRESHOLD = 0.001  # Maximum spread of the variances over the window for the estimator to count as converged
+ESTIMATOR_TIMEOUT = 20  # Number of seconds to wait for the estimator to converge
+RECONNECT_DELAY = 0.5  # Number of seconds before the first attempt to reconnect after losing the link
+RECONNECT_MAX_DELAY = 8  # Upper bound in seconds of the doubling delay between reconnect attempts
+RECONNECT_ATTEMPTS = 8  # Number of attempts to reconnect before the link is given up
+LINK_LOSS_TIMEOUT = 60  # Number of seconds the mission waits for a lost link to come back
+CRUISE_SPEED = 0.2  # Speed in meters per second along the path when scanning while moving
+CONTINUOUS_SCAN_INTERVAL = 2  # Value for esp8266.scanInterval when scanning while moving, in seconds
+LANDING_SPEED = 0.3  # Speed in meters per second of the controlled descent before the motors are stopped
 
 logger = logging.getLogger("rembuilder")
 
 
+def uri_to_tag(link_uri: str) -> str:
+    # radio://0/80/2M/E8E8E8E8E8 -> 0_80_2M_E8E8E8E8E8, used to keep the output files of several drones apart
+    return link_uri.split('://')[-1].strip('/').replace('/', '_')
+
+
 class ScanningDrone:
-    def __init__(self, link_uri, initial_x, initial_y, initial_z, initial_yaw):
-        self._cf = Crazyflie(rw_cache='./cache')
+    def __init__(self, link_uri, initial_x, initial_y, initial_z, initial_yaw, backend=None, output_dir="output",
+                 aggregator=None, raw_output=True, dry_run=False, metrics=METRICS, batch_scans=1, fsync=False,
+                 max_file_size=MAX_FILE_SIZE):
+        self._backend = backend if backend is not None else CflibBackend()
+        self._clock = self._backend.clock
+        # Mission telemetry, labelled with the drone so the metrics of a fleet can be told apart
+        self.metrics = metrics
+        self._labels = {'drone': uri_to_tag(link_uri)}
+        # Durations in seconds of the startup phases, and whether the TOC came from the cache
+        self.startup_times = {}
+        self.toc_cache_hit = None
+        created = self._clock.time()
+        self._cf = self._backend.create_crazyflie()
+        self._startup_phase('create', self._clock.time() - created)
         self.link = link_uri
         self._initial_x = initial_x
         self._initial_y = initial_y
         self._initial_z = initial_z
         self._initial_yaw = initial_yaw
         self.toc_backup = None
-        self.printer = ConsolePrinter(self._cf.console)
-
-        # State
-        self.is_connected = False
-        self.scan_on_demand = False
-        self.scanning = False
-        self.position_estimated = False
+        # Without raw output only the aggregated statistics of the measurements are kept. See MeasurementWriter for the
+        # batch_scans, fsync and max_file_size policy of the output files.
+        self.writer = MeasurementWriter(output_dir, tag=uri_to_tag(link_uri), batch_scans=batch_scans, fsync=fsync,
+                                        max_bytes=max_file_size, metrics=metrics) if raw_output else None
+        self.printer = ConsolePrinter(self._cf.console, sink=self.writer, clock=self._clock,
+                                      tag=uri_to_tag(link_uri))
+        self.aggregator = aggregator
+        if aggregator is not None:
+            self.printer.scan_listeners.append(aggregator.append_scan)
+        self.printer.scan_listeners.append(self._scan_received)
+        self.printer.scan_duration_listeners.append(self._scan_duration_observed)
+
+        # State, set from the cflib callbacks
+        self.connected = Event()
+        self.scan_on_demand_enabled = Event()
+        self.scan_started = Event()
+        self.scan_finished = Event()
+        self.scan_finished.set()
+        self.position_estimated = Event()
+        self.initial_position_set = Event()
         self.initial_kalman = {'initialX': False, 'initialY': False, 'initialZ': False, 'initialYaw': False}
-        self.dry_run = False
+        self._esp8266_callback_added = False
+        self._initial_position_sent = None  # When the initial position was sent, it is only sent once
+        self.dry_run = dry_run
+        self.abort_requested = False
+        self.auto_reconnect = True
+        self._reconnect_attempt = None  # Attempt in progress while recovering from a lost link
+        self._link_lost_at = None
+        self._closing = False
+        self._checkpoint_args = None  # Arguments of the last _save_checkpoint
+
+        # State estimate, updated by the position log
+        self.position = (None, None, None)
+        self.velocity = (None, None, None)
+        self.position_time = None
+        self.trajectory = TrajectoryLog()
+        self.transit_times = []  # (target, seconds, arrived) of every _goto
+        self.setpoint = None  # Last (x, y, z, yaw) position setpoint sent, None while the drone has not taken off
+        self.continuous_scanning = False
 
         # Add basic callbacks
         self._cf.connected.add_callback(self._connected)
@@ -48,95 +113,194 @@ class ScanningDrone:
         self._cf.connection_failed.add_callback(self._connection_failed)
         self._cf.connection_lost.add_callback(self._connection_lost)
 
+        # Radio silence during scans, sized from the scan durations seen on the console
+        self.radio = RadioSilenceScheduler(uri_to_tag(link_uri), self._cf.close_link,
+                                           lambda: self._cf.open_link(self.link), self.connected,
+                                           clock=self._clock, metrics=metrics)
+        self.printer.scan_duration_listeners.append(self.radio.scan_duration_observed)
+
         self.printer.start()
+        self.radio.start()
 
         # Try to connect to the Crazyflie
         logger.info(f'Connecting to {link_uri}')
+        self._link_opened = self._clock.time()
         self._cf.open_link(self.link)
 
+    @property
+    def is_connected(self) -> bool:
+        return self.connected.is_set()
+
+    @property
+    def scan_on_demand(self) -> bool:
+        return self.scan_on_demand_enabled.is_set()
+
+    @property
+    def scanning(self) -> bool:
+        return not self.scan_finished.is_set()
+
+    def _wait_for(self, event: Event, timeout: float, what: str):
+        if not self._clock.wait(event, timeout):
+            raise TimeoutError(f"{self.link}: no {what} after {timeout}s")
+
+    def _startup_phase(self, phase: str, seconds: float):
+        self.startup_times[phase] = seconds
+        self.metrics.observe('startup_seconds', seconds, phase=phase, **self._labels)
+
+    def _scan_received(self, scan):
+        self.metrics.inc('scans_total', **self._labels)
+        self.metrics.observe('aps_per_scan', len(scan), **self._labels)
+
+    def _scan_duration_observed(self, duration: float):
+        # ESP8266 scan durations as measured on the console, from AT+CWLAP to the end of the scan
+        self.metrics.observe('esp8266_scan_seconds', duration, **self._labels)
+
+    def wait_until_connected(self, timeout: float = CONNECT_TIMEOUT):
+        self._wait_for(self.connected, timeout, "connection")
+
     def _param_updated(self, name: str, value):
         logger.debug(f"Parameter {name} updated to {value}")
         if name == SCAN_ON_DEMAND:
-            self.scan_on_demand = bool(int(value))
+            if int(value):
+                self.scan_on_demand_enabled.set()
+            else:
+                self.scan_on_demand_enabled.clear()
             logger.debug(f"self.scan_on_demand: {self.scan_on_demand}")
         elif name == SCAN_NOW:
             # TODO: if scan_now already active, reset to 0
-            self.scanning = bool(int(value))
+            running = bool(int(value))
+            if running:
+                self.scan_finished.clear()
+                self.scan_started.set()
+            else:
+                self.scan_finished.set()
             logger.debug(f"self.scanning: {self.scanning}")
-            if self.scanning:
-                # Disconnect radio to reduce interference, wait a few seconds then reconnect
-                logger.info("Shutting down radio while scanning")
-                self._cf.close_link()
-                time.sleep(RADIO_SHUTDOWN_PERIOD)
-                logger.info("Starting radio again")
-                self._cf.open_link(self.link)
+
+            # Disconnect radio to reduce interference while scanning, this happens on the scheduler's thread. Not
+            # when scanning while moving, the drone needs its setpoints.
+            if not self.radio.scan_state_reported(running) and running and not self.continuous_scanning:
+                self.radio.request()
         elif name.startswith('kalman.initial'):
             self.initial_kalman[name.split('.')[1]] = True
+            if all(self.initial_kalman.values()) and not self.initial_position_set.is_set():
+                self._startup_phase('initial_position', self._clock.time() - self._initial_position_sent)
+                self.initial_position_set.set()
 
     def _connected(self, *args):
-        self._cf.param.add_update_callback(group="esp8266", cb=self._param_updated)
+        if self._reconnect_attempt is not None:
+            logger.info(f"{self.link}: link restored after {self._reconnect_attempt + 1} attempt(s)")
+            self._reconnect_attempt = None
+        if self._link_lost_at is not None:
+            self.metrics.observe('link_recovery_seconds', self._clock.time() - self._link_lost_at, **self._labels)
+            self._link_lost_at = None
+        # Parameter callbacks survive a reconnect, so they are only added once
+        if not self._esp8266_callback_added:
+            self._startup_phase('link', self._clock.time() - self._link_opened)
+            self.toc_cache_hit = self._backend.toc_cache_hit(self._cf)
+            self._cf.param.add_update_callback(group="esp8266", cb=self._param_updated)
+            self._esp8266_callback_added = True
+            # The initial position goes out right away, its confirmations arrive while the rest of the fleet is still
+            # connecting instead of after initialize() is called
+            if not self.dry_run:
+                self._send_initial_position()
         if not self.scan_on_demand:
             self._cf.param.set_value(SCAN_ON_DEMAND, 1)
-        self.is_connected = True
+        self._start_position_log()
+        self.connected.set()
+
+    def _start_position_log(self):
+        # Log configurations do not survive a reconnect, so this is set up again on every connection
+        log_config = self._backend.log_config('Position', POSITION_LOG_PERIOD)
+        for variable in ('x', 'y', 'z', 'vx', 'vy', 'vz'):
+            log_config.add_variable(f'stateEstimate.{variable}', 'float')
+
+        try:
+            self._cf.log.add_config(log_config)
+            log_config.data_received_cb.add_callback(self._position_received)
+            log_config.start()
+        except (KeyError, AttributeError) as e:
+            logger.warning(f"Could not start position log, waypoints will use the full {TIME_TO_WAYPOINT}s: {e}")
+
+    def _position_received(self, timestamp, data, log_config):
+        self.position = (data['stateEstimate.x'], data['stateEstimate.y'], data['stateEstimate.z'])
+        self.velocity = (data['stateEstimate.vx'], data['stateEstimate.vy'], data['stateEstimate.vz'])
+        self.position_time = self._clock.time()
+        self.trajectory.append(self.position_time, *self.position)
 
     def _disconnected(self, *args):
+        self.connected.clear()
         logger.info(f"Disconnected...")
 
     def _connection_failed(self, *args):
+        self.connected.clear()
         logger.error(f"Connection failed")
+        # Not only while recovering from a lost link, reopening the link after a radio silence can fail as well
+        if self.auto_reconnect and not self._closing:
+            self._schedule_reconnect(self._reconnect_attempt + 1 if self._reconnect_attempt is not None else 0)
 
     def _connection_lost(self, *args):
+        self.connected.clear()
         logger.info(f"Connection lost...")
-        # self._cf.open_link(self.link)
+        self.metrics.inc('link_lost_total', **self._labels)
+        if self._link_lost_at is None:
+            self._link_lost_at = self._clock.time()
+        if self.auto_reconnect and not self._closing:
+            self._schedule_reconnect(0)
+
+    def _schedule_reconnect(self, attempt: int):
+        # Reconnects from a timer thread, the cflib callbacks must not block. The delay doubles with every failed
+        # attempt, up to RECONNECT_MAX_DELAY.
+        if attempt >= RECONNECT_ATTEMPTS:
+            logger.error(f"{self.link}: giving up on the link after {attempt} attempts")
+            self.metrics.inc('link_given_up_total', **self._labels)
+            self._reconnect_attempt = None
+            return
+        self._reconnect_attempt = attempt
+        delay = min(RECONNECT_DELAY * 2 ** attempt, RECONNECT_MAX_DELAY)
+        self._clock.call_later(delay, self._reconnect, attempt)
+
+    def _reconnect(self, attempt: int):
+        if self._closing or self.connected.is_set() or self._reconnect_attempt != attempt:
+            return
+        logger.info(f"{self.link}: reconnecting (attempt {attempt + 1})")
+        self.metrics.inc('reconnect_attempts_total', **self._labels)
+        self._cf.open_link(self.link)
+
+    def _ensure_connected(self):
+        # Holds the mission while a lost link is being restored
+        if not self.is_connected and not self.dry_run:
+            logger.warning(f"{self.link}: waiting for the link to come back")
+            self._wait_for(self.connected, LINK_LOSS_TIMEOUT, "link")
 
-    def wait_for_position_estimator(self):
-        self.position_estimated = False
+    def wait_for_position_estimator(self, period=ESTIMATOR_LOG_PERIOD, window=ESTIMATOR_WINDOW,
+                                    threshold=ESTIMATOR_THRESHOLD, timeout=ESTIMATOR_TIMEOUT):
+        # Waits until the variance of the position estimate has been stable for window samples, logged every period
+        # milliseconds. Gives up after timeout seconds, position_estimated is only set on convergence.
+        self.position_estimated.clear()
 
         logger.info('Waiting for estimator to find position...')
 
-        log_config = LogConfig(name='Kalman Variance', period_in_ms=500)
-        log_config.add_variable('kalman.varPX', 'float')
-        log_config.add_variable('kalman.varPY', 'float')
-        log_config.add_variable('kalman.varPZ', 'float')
-
-        var_y_history = [1000] * 10
-        var_x_history = [1000] * 10
-        var_z_history = [1000] * 10
-
-        threshold = 0.001
-        counter = 0
-
-        with SyncLogger(self._cf, log_config) as sync_logger:
-            for log_entry in sync_logger:
-                data = log_entry[1]
-
-                var_x_history.append(data['kalman.varPX'])
-                var_x_history.pop(0)
-                var_y_history.append(data['kalman.varPY'])
-                var_y_history.pop(0)
-                var_z_history.append(data['kalman.varPZ'])
-                var_z_history.pop(0)
-
-                min_x = min(var_x_history)
-                max_x = max(var_x_history)
-                min_y = min(var_y_history)
-                max_y = max(var_y_history)
-                min_z = min(var_z_history)
-                max_z = max(var_z_history)
-
-                # print("{} {} {}".
-                #       format(max_x - min_x, max_y - min_y, max_z - min_z))
-
-                counter += 1
-
-                if (max_x - min_x) < threshold and (
-                        max_y - min_y) < threshold and (
-                        max_z - min_z) < threshold:
-                    logger.info("Position found!")
-                    self.position_estimated = True
-                    break
-                else:
-                    logger.debug(f"Tried {counter} times")
+        detector = ConvergenceDetector(('kalman.varPX', 'kalman.varPY', 'kalman.varPZ'), window, threshold)
+        log_config = self._backend.log_config('Kalman Variance', period)
+        for variable in detector.variables:
+            log_config.add_variable(variable, 'float')
+
+        def variance_received(timestamp, data, log_config):
+            if detector.add(data):
+                self.position_estimated.set()
+
+        self._cf.log.add_config(log_config)
+        log_config.data_received_cb.add_callback(variance_received)
+        log_config.start()
+        try:
+            if self._clock.wait(self.position_estimated, timeout):
+                logger.info("Position found!")
+            else:
+                logger.error(f"{self.link}: estimator did not converge within {timeout}s after {detector.samples} "
+                             f"samples, variance spread {detector.spread()}")
+        finally:
+            log_config.delete()
+            log_config.data_received_cb.remove_callback(variance_received)
 
     def _set_initial_position(self):
         self._cf.param.set_value('kalman.initialX', self._initial_x)
@@ -148,38 +312,81 @@ class ScanningDrone:
 
     def _reset_estimator(self):
         self._cf.param.set_value('kalman.resetEstimation', '1')
-        time.sleep(0.1)
+        self._clock.sleep(0.1)
         self._cf.param.set_value('kalman.resetEstimation', '0')
         # self._cf.param.set_value('kalman.robustTwr', '1')
         # self._cf.param.set_value('kalman.robustTdoa', '1')
         self.wait_for_position_estimator()
 
-    def initialize(self):
-        # Set initial position
-        logger.info("Connected, setting initial position...")
+    def _send_initial_position(self):
+        # Set initial position, the callback is added first so no confirmation can be missed
+        if self._initial_position_sent is not None:
+            return
+        self._initial_position_sent = self._clock.time()
+        self._cf.param.add_update_callback(group="kalman", cb=self._param_updated)
         self._set_initial_position()
 
+    def initialize(self):
+        logger.info("Connected, setting initial position...")
         if not self.dry_run:
-            self._cf.param.add_update_callback(group="kalman", cb=self._param_updated)
+            self._send_initial_position()
             logger.info('Waiting for position fix...')
-            while not all(self.initial_kalman.values()):
-                logger.debug(self.initial_kalman)
-                time.sleep(0.5)
-            self._cf.param.remove_update_callback(group="kalman", cb=self._param_updated)
+            try:
+                self._wait_for(self.initial_position_set, PARAM_TIMEOUT, f"confirmation of {self.initial_kalman}")
+            finally:
+                self._cf.param.remove_update_callback(group="kalman", cb=self._param_updated)
 
+            started = self._clock.time()
             self._reset_estimator()
+            self._startup_phase('estimator', self._clock.time() - started)
 
-            # Block until we know our (initial) position
-            while not self.position_estimated:
-                time.sleep(0.5)
+            # We need to know our (initial) position before flying
+            if not self.position_estimated.is_set():
+                raise RuntimeError(f"{self.link}: position estimator did not converge")
         else:
+            self._set_initial_position()
             logger.info("Dry-run active, skipping position fix...")
 
-    def scan_waypoints(self, waypoints):
+    def _save_checkpoint(self, checkpoint, next_waypoint, base_scans, base_measurements, base_output):
+        checkpoint.next_waypoint = next_waypoint
+        # The console may still be delivering the last scan, the checkpoint is saved once more on disconnecting
+        self._checkpoint_args = (checkpoint, next_waypoint, base_scans, base_measurements, base_output)
+        checkpoint.scans = base_scans + self.printer.scan_count
+        checkpoint.measurements = base_measurements + self.printer.measurement_count
+        filenames = self.writer.filenames if self.writer is not None else []
+        checkpoint.output = base_output + [filename for filename in filenames if filename not in base_output]
+        checkpoint.estimator = {
+            'position': list(self.position),
+            'velocity': list(self.velocity),
+            'initial': [self._initial_x, self._initial_y, self._initial_z, self._initial_yaw],
+            'converged': self.position_estimated.is_set(),
+        }
+        checkpoint.done = next_waypoint >= checkpoint.waypoint_count
+        checkpoint.save()
+
+    def scan_waypoints(self, waypoints, checkpoint=None):
+        # With a checkpoint the progress is saved after every waypoint. Waypoints the checkpoint has a completed scan
+        # for (when resuming a mission) are skipped, those without a scan (take-off, landing, ...) are always flown.
+        if checkpoint is not None:
+            if checkpoint.done:
+                logger.info(f"{self.link}: mission already completed according to {checkpoint.filename}")
+                return
+            if checkpoint.scanned:
+                logger.info(f"{self.link}: resuming, skipping {len(checkpoint.scanned)} scanned waypoints")
+            base = (checkpoint.scans, checkpoint.measurements, list(checkpoint.output))
+
         for pos_id, position in enumerate(waypoints):
+            if self.abort_requested:
+                logger.warning(f"{self.link}: mission aborted at waypoint {pos_id}")
+                break
+
+            if position[4] and checkpoint is not None and checkpoint.is_scanned(pos_id):
+                continue
+
             logger.info(f'Setting waypoint {position[0:3]} and {"scanning" if position[4] else "not scanning"}')
 
             if not self.dry_run:
+                self._ensure_connected()
                 self._goto(
                     self._initial_x + position[0],
                     self._initial_y + position[1],
@@ -188,39 +395,163 @@ class ScanningDrone:
                 )  # blocking
 
             if position[4]:
+                self._ensure_connected()
+                started = self._clock.time()
                 self._access_point_scan()
-                while self.scanning:
-                    time.sleep(0.2)
+                self._wait_for(self.scan_finished, SCAN_TIMEOUT, "end of scan")
+                # From asking for the scan until scanNow was reset, including the radio silence and reconnecting
+                self.metrics.observe('waypoint_scan_seconds', self._clock.time() - started, **self._labels)
+                if checkpoint is not None:
+                    checkpoint.scanned.append(pos_id)
+
+            if checkpoint is not None:
+                self._save_checkpoint(checkpoint, pos_id + 1, *base)
+
+    def _is_settled(self, x, y, z) -> bool:
+        if self.position_time is None or self._clock.time() - self.position_time > POSITION_MAX_AGE:
+            return False
+        return math.dist(self.position, (x, y, z)) < POSITION_TOLERANCE and \
+            math.hypot(*self.velocity) < VELOCITY_TOLERANCE
 
     def _goto(self, x, y, z, yaw):
-        iterations = int(TIME_TO_WAYPOINT / ITERATION_FREQUENCY)
-        for _ in range(iterations):
+        # Keep sending the setpoint until the state estimate has been within the tolerances for SETTLING_TIME, or
+        # until TIME_TO_WAYPOINT has passed
+        start = self._clock.time()
+        settled_since = None
+        arrived = False
+        self.setpoint = (x, y, z, yaw)
+        while self._clock.time() - start < TIME_TO_WAYPOINT:
             self._cf.commander.send_position_setpoint(x, y, z, yaw)
-            time.sleep(ITERATION_FREQUENCY)
+            self._clock.sleep(ITERATION_FREQUENCY)
+
+            if self._is_settled(x, y, z):
+                now = self._clock.time()
+                settled_since = settled_since if settled_since is not None else now
+                if now - settled_since >= SETTLING_TIME:
+                    arrived = True
+                    break
+            else:
+                settled_since = None
+
+        transit = self._clock.time() - start
+        self.transit_times.append(((x, y, z), transit, arrived))
+        self.metrics.observe('goto_seconds', transit, arrived=arrived, **self._labels)
+        logger.debug(f"{'Arrived at' if arrived else 'Timed out going to'} ({x:.2f}, {y:.2f}, {z:.2f}) "
+                     f"after {transit:.2f}s")
+
+    def _fly_segment(self, start, end, speed):
+        # Moves the setpoint along a straight line at speed, instead of jumping to the end
+        steps = max(1, math.ceil(math.dist(start[:3], end[:3]) / (speed * ITERATION_FREQUENCY)))
+        for step in range(1, steps + 1):
+            fraction = step / steps
+            self.setpoint = tuple(a + (b - a) * fraction for a, b in zip(start, end))
+            self._cf.commander.send_position_setpoint(*self.setpoint)
+            self._clock.sleep(ITERATION_FREQUENCY)
+
+    def scan_continuous(self, waypoints, speed=CRUISE_SPEED, interval=CONTINUOUS_SCAN_INTERVAL):
+        # Flies the waypoints as one path at speed while the ESP8266 scans every interval seconds by itself. The
+        # radio stays on and the position of every AP is interpolated from the state estimate log. The scan flag of
+        # the waypoints is ignored.
+        targets = [
+            (self._initial_x + w[0], self._initial_y + w[1], self._initial_z + w[2], self._initial_yaw + w[3])
+            for w in waypoints
+        ]
+        if self.dry_run or not targets:
+            logger.info("Dry-run active, skipping continuous scan...")
+            return
+
+        logger.info(f"Scanning while moving along {len(targets)} waypoints at {speed}m/s")
+        self._goto(*targets[0])
+
+        scans, measurements = self.printer.scan_count, self.printer.measurement_count
+        started = self._clock.time()
+        self.continuous_scanning = True
+        self.printer.position_source = self.trajectory.position_at
+        self._cf.param.set_value(SCAN_INTERVAL, interval)
+        self._cf.param.set_value(SCAN_ON_DEMAND, 0)
+        try:
+            for start, end in zip(targets, targets[1:]):
+                if self.abort_requested:
+                    logger.warning(f"{self.link}: continuous scan aborted")
+                    break
+                self._fly_segment(start, end, speed)
+        finally:
+            self._cf.param.set_value(SCAN_ON_DEMAND, 1)
+            self.continuous_scanning = False
+
+        minutes = (self._clock.time() - started) / 60
+        measurements = self.printer.measurement_count - measurements
+        logger.info(f"Continuous scan: {self.printer.scan_count - scans} scans, {measurements} measurements in "
+                    f"{minutes:.1f} minutes ({measurements / minutes if minutes else 0:.0f} per minute)")
 
     def _access_point_scan(self):
+        # Positions of hovering scans come from the POS line
+        self.printer.position_source = None
+
         # Wait until scan on demand is active (this happens async on connection to Crazyflie)
-        while not self.scan_on_demand:
-            time.sleep(0.1)
+        self._wait_for(self.scan_on_demand_enabled, PARAM_TIMEOUT, "scan on demand")
 
         # Perform a scan
+        self.scan_started.clear()
+        requested = self._clock.time()
         self._cf.param.set_value(SCAN_NOW, 1)
-        while not self.scanning:
-            time.sleep(0.1)
-
-    def shutdown(self):
-        # Land the Crazyflie
-        self._cf.commander.send_stop_setpoint()
+        self._wait_for(self.scan_started, PARAM_TIMEOUT, "start of scan")
+        self.metrics.observe('param_roundtrip_seconds', self._clock.time() - requested, param=SCAN_NOW, **self._labels)
 
-        # Close thread and link and USB radio
+    def land(self):
+        # Land the Crazyflie. Stopping cuts the motors, so a drone that is still in the air (after a failure or an
+        # abort mid-mission) first descends under control to LANDING_HEIGHT above its start position.
+        try:
+            if not self.dry_run and self.is_connected:
+                self._descend()
+        finally:
+            self._cf.commander.send_stop_setpoint()
+
+    def _descend(self):
+        if self.setpoint is None:
+            return
+        yaw = self.setpoint[3]
+        if self.position_time is not None and self._clock.time() - self.position_time <= POSITION_MAX_AGE:
+            current = (*self.position, yaw)
+        else:
+            current = self.setpoint
+        landing_z = self._initial_z + LANDING_HEIGHT
+        if current[2] <= landing_z + POSITION_TOLERANCE:
+            return
+
+        logger.info(f"{self.link}: descending from {current[2]:.2f}m before stopping the motors")
+        target = (current[0], current[1], landing_z, yaw)
+        self._fly_segment(current, target, LANDING_SPEED)
+        self._goto(*target)
+
+    def disconnect(self):
+        # Close thread and link
+        self._closing = True
+        self.radio.stop()
         self.printer.stop = True
+        self.printer.join()
+        self._console_metrics()
+        if self._checkpoint_args is not None:
+            self._save_checkpoint(*self._checkpoint_args)
         self._cf.close_link()
-        cflib.crtp.get_link_driver(self.link).close()
-        time.sleep(5)
 
-        # Power down the CF
+    def _console_metrics(self):
+        # Parse throughput of the console, the printer keeps these counts itself
+        self.metrics.inc('console_chars_total', self.printer.chars_received, **self._labels)
+        self.metrics.inc('console_lines_total', self.printer.lines_parsed, **self._labels)
+        self.metrics.inc('console_parse_seconds_total', self.printer.parse_time, **self._labels)
+
+    def power_down(self):
+        # Close the USB radio, then power down the CF
+        self._backend.close_link_driver(self.link)
+        self._clock.sleep(5)
+
         try:
-            ps = PowerSwitch(self.link)
-            ps.platform_power_down()
+            self._backend.power_down(self.link)
         except:
             pass
+
+    def shutdown(self):
+        self.land()
+        self.disconnect()
+        self.power_down()
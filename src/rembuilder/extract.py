@@ -0,0 +1,160 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import glob
+import logging
+import mmap
+import os
+import re
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+from .utils import ScanParser
+from .writer import MeasurementWriter
+
+logger = logging.getLogger("rembuilder")
+
+# Console lines in the *_console_debug.out files written by main.py (see replay.PTN_DEBUG_LOG), matched on the raw
+# bytes of the whole file so other log lines are skipped without decoding them. The drone tag is missing in logs
+# written before it was added, those hold the console of a single drone.
+PTN_CONSOLE_LINE = re.compile(rb'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) \[[^\]\n]*\] \[DEBUG\] '
+                              rb'CF(?:\[([^\]\n]*)\])?: ([^\n]*)$', re.MULTILINE)
+CONSOLE_DEBUG_SUFFIX = "_console_debug.out"
+BATCH_SCANS = 1000  # Number of scans the writer collects before writing, there is no crash to guard against here
+
+
+def parse_log_time(text: bytes) -> datetime:
+    # 2021-05-01 14:03:12 (the part before the milliseconds), about ten times faster than strptime
+    return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]), int(text[11:13]), int(text[14:16]),
+                    int(text[17:19]))
+
+
+def log_tag(filename: str) -> str:
+    # output/20210501_140312_rembuilder_console_debug.out -> 20210501_140312
+    name = os.path.basename(filename)
+    for suffix in (CONSOLE_DEBUG_SUFFIX, ".out"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    if name.endswith("_rembuilder"):
+        name = name[:-len("_rembuilder")]
+    return name
+
+
+def local_utc_offset(moment: datetime) -> timedelta:
+    # The log times are local time, measurement times are UTC
+    timestamp = moment.timestamp()
+    return datetime.utcfromtimestamp(timestamp) - datetime.fromtimestamp(timestamp)
+
+
+def extract_file(filename: str, output_dir: str, utc_offset: Optional[float] = None) -> dict:
+    # Runs the scan state machine over a memory mapped console log, writing the scans with a MeasurementWriter. The
+    # drones of a fleet all log to the same file, every drone tag gets its own state machine and output file.
+    started = time.perf_counter()
+    parsers: Dict[bytes, Tuple[ScanParser, MeasurementWriter]] = {}
+    offset = timedelta(hours=utc_offset) if utc_offset is not None else None
+    lines = 0
+    last_second = None
+    second = None
+
+    with open(filename, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for mo in PTN_CONSOLE_LINE.finditer(mm):
+                    time_text, drone, line = mo.groups()
+                    # Many lines share the same second, only the milliseconds have to be filled in for those
+                    if time_text[:19] != last_second:
+                        last_second = time_text[:19]
+                        second = parse_log_time(time_text)
+                        if offset is None:
+                            offset = local_utc_offset(second)
+                        second += offset
+                    now = second.replace(microsecond=int(time_text[20:23]) * 1000)
+                    entry = parsers.get(drone)
+                    if entry is None:
+                        tag = log_tag(filename) + (f"_{drone.decode('utf-8', 'replace')}" if drone else "")
+                        entry = parsers[drone] = (ScanParser(), MeasurementWriter(output_dir, tag=tag,
+                                                                                   batch_scans=BATCH_SCANS))
+                    parser, writer = entry
+                    scan = parser.parse_line(line.decode('utf-8', 'replace').rstrip('\r'), now)
+                    if scan is not None:
+                        writer.write_scan(scan)
+                    lines += 1
+
+    writers = [writer for _, writer in parsers.values()]
+    for writer in writers:
+        writer.close()
+
+    return {
+        'filename': filename,
+        'bytes': size,
+        'lines': lines,
+        'drones': len(writers),
+        'scans': sum(writer.scan_count for writer in writers),
+        'measurements': sum(writer.measurement_count for writer in writers),
+        'output': [f for writer in writers for f in writer.filenames],
+        'elapsed': time.perf_counter() - started,
+    }
+
+
+def find_logs(paths: List[str]) -> List[str]:
+    # Directories are searched for console debug logs, largest files first so the pool stays busy until the end
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(glob.glob(os.path.join(path, "*" + CONSOLE_DEBUG_SUFFIX)))
+        else:
+            filenames.append(path)
+    return sorted(filenames, key=os.path.getsize, reverse=True)
+
+
+def report_file(result: dict):
+    print(f"{result['filename']}: {result['measurements']} measurements in {result['scans']} scans of "
+          f"{result['drones']} drone(s) ({result['elapsed']:.1f}s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-extract measurements from *_console_debug.out logs into "
+                                                 "standard measurement files")
+    parser.add_argument('paths', nargs='+', help="console debug logs, or directories containing them")
+    parser.add_argument('--output', default="output", help="directory for the measurement files")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="number of files processed in parallel")
+    parser.add_argument('--utc-offset', type=float, default=None,
+                        help="hours to add to the log times to get UTC, default is the local timezone of this machine")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.WARNING)
+
+    filenames = find_logs(args.paths)
+    os.makedirs(args.output, exist_ok=True)
+
+    started = time.perf_counter()
+    results = []
+    if args.jobs <= 1:
+        for filename in filenames:
+            results.append(extract_file(filename, args.output, args.utc_offset))
+            report_file(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(extract_file, filename, args.output, args.utc_offset): filename
+                       for filename in filenames}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"{futures[future]}: failed ({e})")
+                    continue
+                report_file(results[-1])
+    elapsed = time.perf_counter() - started
+
+    total_bytes = sum(result['bytes'] for result in results)
+    total_measurements = sum(result['measurements'] for result in results)
+    print(f"Extracted {total_measurements} measurements from {len(results)} files ({total_bytes / 1e6:.1f} MB) in "
+          f"{elapsed:.1f}s, {total_bytes / 1e6 / elapsed if elapsed > 0 else 0:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
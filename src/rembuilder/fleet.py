@@ -0,0 +1,191 @@
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from .backend import CflibBackend
+from .checkpoint import MissionCheckpoint, checkpoint_filename
+from .drone import CONNECT_TIMEOUT, ScanningDrone, uri_to_tag
+from .metrics import METRICS
+from .writer import MAX_FILE_SIZE
+
+logger = logging.getLogger("rembuilder")
+
+HOVER = "hover"  # Scan while hovering at every waypoint with a scan
+CONTINUOUS = "continuous"  # Fly the waypoints as one path while the ESP8266 scans periodically, see scan_continuous
+MODES = (HOVER, CONTINUOUS)
+
+
+class DroneRun:
+    # Bookkeeping of a single drone within a fleet run, timed on the clock of the backend
+    def __init__(self, config: dict, clock, metrics=METRICS):
+        self.config = config
+        self.clock = clock
+        self.metrics = metrics
+        self.uri = config["uri"]
+        self.drone: Optional[ScanningDrone] = None
+        self.error: Optional[BaseException] = None
+        self.phase_times: Dict[str, float] = {}
+        self.started = None
+        self.takeoff = None
+        self.finished = None
+
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def timed(self, phase: str, function, *args):
+        start = self.clock.time()
+        try:
+            return function(*args)
+        finally:
+            self.phase_times[phase] = self.clock.time() - start
+            self.metrics.observe('phase_seconds', self.phase_times[phase], drone=uri_to_tag(self.uri), phase=phase)
+
+
+# Connects, initializes and flies a list of drones (in the format used in main.py) at the same time, one thread per
+# drone. A drone that fails is landed (see ScanningDrone.land) and dropped without affecting the others. The radio
+# links are only closed once every drone is done, since drones usually share the same Crazyradio.
+class FleetRunner:
+    def __init__(self, drones: List[dict], dry_run: bool = False, connect_timeout: float = CONNECT_TIMEOUT,
+                 backend=None, output_dir: str = "output", aggregator=None, raw_output: bool = True, live=None,
+                 checkpoint_dir: Optional[str] = None, resume: bool = False, metrics=METRICS,
+                 metrics_file: Optional[str] = None, mode: str = HOVER, batch_scans: int = 1, fsync: bool = False,
+                 max_file_size: int = MAX_FILE_SIZE):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mission mode {mode}, use one of {MODES}")
+        self.backend = backend if backend is not None else CflibBackend()
+        self.clock = self.backend.clock
+        self.metrics = metrics
+        self.metrics_file = metrics_file  # The metrics are written here (JSON) once the fleet is done
+        self.runs = [DroneRun(config, self.clock, metrics) for config in drones]
+        self.output_dir = output_dir
+        self.aggregator = aggregator  # Shared by all drones, so they build one set of statistics together
+        self.raw_output = raw_output
+        self.writer_options = {'batch_scans': batch_scans, 'fsync': fsync, 'max_file_size': max_file_size}
+        self.live = live  # Optional LiveServer the scans of all drones are published on
+        self.checkpoint_dir = checkpoint_dir  # Progress of every drone is saved here after each waypoint
+        self.resume = resume  # Skip the waypoints scanned according to the checkpoints in checkpoint_dir
+        self.mode = mode  # Default for the drones without a "mode" of their own
+        self.dry_run = dry_run
+        self.connect_timeout = connect_timeout
+        self.started = None
+        self.finished = None
+
+    def _connect(self, run: DroneRun):
+        config = run.config
+        run.drone = ScanningDrone(
+            config["uri"],
+            config["start_x"],
+            config["start_y"],
+            config["start_z"],
+            config["start_yaw"],
+            backend=self.backend,
+            output_dir=self.output_dir,
+            aggregator=self.aggregator,
+            raw_output=self.raw_output,
+            dry_run=self.dry_run,
+            metrics=self.metrics,
+            **self.writer_options
+        )
+        if self.live is not None:
+            self.live.attach(run.drone)
+        run.drone.wait_until_connected(self.connect_timeout)
+
+    def _checkpoint(self, run: DroneRun) -> Optional[MissionCheckpoint]:
+        if self.checkpoint_dir is None:
+            return None
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        filename = checkpoint_filename(self.checkpoint_dir, uri_to_tag(run.uri))
+        if self.resume:
+            return MissionCheckpoint.load(filename, run.uri, run.config["sequence"])
+        return MissionCheckpoint(filename, run.uri, run.config["sequence"])
+
+    def _fly(self, run: DroneRun):
+        run.started = self.clock.time()
+        try:
+            run.timed("connect", self._connect, run)
+            run.timed("initialize", run.drone.initialize)
+            run.takeoff = self.clock.time()
+            mode = run.config.get("mode", self.mode)
+            if mode == CONTINUOUS:
+                # The path is flown in one go, there are no per-waypoint scans to checkpoint
+                run.timed("scan", run.drone.scan_continuous, run.config["sequence"])
+            elif mode == HOVER:
+                run.timed("scan", run.drone.scan_waypoints, run.config["sequence"], self._checkpoint(run))
+            else:
+                raise ValueError(f"Unknown mission mode {mode}, use one of {MODES}")
+        except Exception as e:
+            run.error = e
+            logger.exception(f"{run.uri}: mission failed")
+        finally:
+            if run.drone is not None:
+                try:
+                    run.drone.land()
+                except Exception:
+                    logger.exception(f"{run.uri}: landing failed")
+            run.finished = self.clock.time()
+
+    def _shutdown(self, pool: ThreadPoolExecutor):
+        drones = [run for run in self.runs if run.drone is not None]
+        for run in drones:
+            try:
+                run.timed("disconnect", run.drone.disconnect)
+            except Exception:
+                logger.exception(f"{run.uri}: disconnect failed")
+        # Power down happens in parallel, each drone waits a few seconds for its link to settle
+        for future in [pool.submit(run.timed, "power_down", run.drone.power_down) for run in drones]:
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Power down failed")
+
+    def abort(self):
+        for run in self.runs:
+            if run.drone is not None:
+                run.drone.abort_requested = True
+
+    def run(self) -> List[DroneRun]:
+        self.started = self.clock.time()
+        cache = self.backend.prepare_cache()
+        if cache['valid'] or cache['removed']:
+            logger.info(f"TOC cache: {cache['valid']} valid files, {cache['removed']} removed")
+        with ThreadPoolExecutor(max_workers=max(1, len(self.runs)), thread_name_prefix="drone") as pool:
+            futures = [pool.submit(self._fly, run) for run in self.runs]
+            try:
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                logger.warning("Interrupted, aborting all drones...")
+                self.abort()
+                for future in futures:
+                    future.result()
+            finally:
+                self._shutdown(pool)
+        self.finished = self.clock.time()
+        self.metrics.observe('fleet_seconds', self.finished - self.started)
+        self.report()
+        if self.metrics_file is not None:
+            try:
+                self.metrics.save(self.metrics_file)
+            except OSError:
+                logger.exception(f"Could not write metrics to {self.metrics_file}")
+        return self.runs
+
+    def report(self):
+        for run in self.runs:
+            phases = ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in run.phase_times.items())
+            status = "failed" if run.error is not None else "done"
+            logger.info(f"{run.uri}: {status} in {run.duration:.1f}s ({phases})")
+            if run.drone is not None and run.drone.startup_times:
+                startup = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in run.drone.startup_times.items())
+                cache = {True: "TOC cache hit", False: "TOC cache miss", None: "TOC cache unknown"}
+                logger.info(f"{run.uri}: startup {startup}, {cache[run.drone.toc_cache_hit]}")
+        takeoffs = [run.takeoff for run in self.runs if run.takeoff is not None]
+        if takeoffs:
+            logger.info(f"First takeoff {min(takeoffs) - self.started:.1f}s after launch, last after "
+                        f"{max(takeoffs) - self.started:.1f}s")
+        logger.info(f"Fleet of {len(self.runs)} drones finished in {self.finished - self.started:.1f}s")
@@ -0,0 +1,193 @@
+from itertools import product
+import logging
+import math
+
+from threading import RLock
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .columnar import DTYPES
+from .store import MeasurementStore
+
+logger = logging.getLogger("rembuilder")
+
+Cell = Tuple[int, int, int]
+
+CELL_SIZE = 0.5  # Edge length in meters of the cells of the spatial grid
+CELL_BITS = 21  # Bits per axis when packing a cell into a single integer key, plenty for any room
+CELL_OFFSET = 1 << (CELL_BITS - 1)
+CELL_MASK = (1 << CELL_BITS) - 1
+
+
+class _RowLists:
+    # Rows per key, grown by appending numpy chunks and compacted into a single array the first time they are read
+    def __init__(self):
+        self.chunks: Dict[Hashable, List[np.ndarray]] = {}
+
+    def add(self, key: Hashable, rows: np.ndarray):
+        self.chunks.setdefault(key, []).append(rows)
+
+    def get(self, key: Hashable) -> np.ndarray:
+        chunks = self.chunks.get(key)
+        if not chunks:
+            return np.zeros(0, dtype=np.int64)
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks)]
+        return chunks[0]
+
+    def keys(self):
+        return self.chunks.keys()
+
+
+def _group(keys: np.ndarray, rows: np.ndarray):
+    # Yields (key, rows) for every distinct key, rows in ascending order
+    order = np.argsort(keys, kind='stable')
+    unique, starts = np.unique(keys[order], return_index=True)
+    for key, group in zip(unique.tolist(), np.split(rows[order], starts[1:])):
+        yield key, group
+
+
+# Per-AP and spatial index over a MeasurementStore (or MappedMeasurementStore). Rows are indexed by MAC id, SSID id and
+# by the cell of a uniform grid they fall in. The store is append-only, update() indexes the rows added since the last
+# call, so the index can follow a store that is filled during a mission (see append_scan).
+#
+# The columns of an array.array based store are read through temporary numpy views, and the store cannot grow while
+# such a view exists (BufferError, possibly halfway through a row). During a mission the store must therefore only be
+# appended to through append_scan and read through the index, which hold the same lock. Anything else that reads the
+# columns of the store while it is being filled, e.g. rem.build_rem, has to hold index.lock as well.
+class MeasurementIndex:
+    def __init__(self, store: MeasurementStore, cell_size: float = CELL_SIZE):
+        self.store = store
+        self.cell_size = cell_size
+        self.lock = RLock()
+        self.indexed = 0
+        self._by_mac = _RowLists()
+        self._by_ssid = _RowLists()
+        self._by_cell = _RowLists()
+        self._low = np.full(3, np.inf)  # Bounding box of the indexed positions
+        self._high = np.full(3, -np.inf)
+        self.update()
+
+    def _column(self, name: str) -> np.ndarray:
+        return np.frombuffer(getattr(self.store, name), dtype=DTYPES[name])
+
+    def _positions(self, rows) -> np.ndarray:
+        return np.stack([self._column('x')[rows], self._column('y')[rows], self._column('z')[rows]], axis=1)
+
+    def cell_of(self, point: Sequence[float]) -> Cell:
+        return tuple(int(math.floor(value / self.cell_size)) for value in point)
+
+    def cell_center(self, cell: Cell) -> Tuple[float, float, float]:
+        return tuple((index + 0.5) * self.cell_size for index in cell)
+
+    def _cell_keys(self, cells: np.ndarray) -> np.ndarray:
+        cells = cells + CELL_OFFSET
+        return (cells[:, 0] << (2 * CELL_BITS)) | (cells[:, 1] << CELL_BITS) | cells[:, 2]
+
+    def _key_cell(self, key: int) -> Cell:
+        return (((key >> (2 * CELL_BITS)) & CELL_MASK) - CELL_OFFSET, ((key >> CELL_BITS) & CELL_MASK) - CELL_OFFSET,
+                (key & CELL_MASK) - CELL_OFFSET)
+
+    def update(self) -> int:
+        # Indexes the rows appended to the store since the last update, returns how many there were
+        with self.lock:
+            start, end = self.indexed, len(self.store)
+            if end <= start:
+                return 0
+            rows = np.arange(start, end, dtype=np.int64)
+            for key, group in _group(self._column('mac')[start:end].astype(np.int64), rows):
+                self._by_mac.add(key, group)
+            for key, group in _group(self._column('ssid')[start:end].astype(np.int64), rows):
+                self._by_ssid.add(key, group)
+            positions = self._positions(slice(start, end))
+            self._low = np.minimum(self._low, positions.min(axis=0))
+            self._high = np.maximum(self._high, positions.max(axis=0))
+            cells = np.floor(positions / self.cell_size).astype(np.int64)
+            for key, group in _group(self._cell_keys(cells), rows):
+                self._by_cell.add(self._key_cell(key), group)
+            self.indexed = end
+            return end - start
+
+    # Can be registered as a ConsolePrinter scan listener, instead of the append_scan of the store itself
+    def append_scan(self, scan):
+        with self.lock:
+            self.store.extend(scan)
+            self.update()
+
+    def rows_for_mac(self, mac: str) -> np.ndarray:
+        with self.lock:
+            mac_id = self.store.macs.ids.get(str(mac).rjust(12, '0'))
+            return self._by_mac.get(mac_id) if mac_id is not None else np.zeros(0, dtype=np.int64)
+
+    def rows_for_ssid(self, ssid: str) -> np.ndarray:
+        with self.lock:
+            ssid_id = self.store.ssids.ids.get(ssid)
+            return self._by_ssid.get(ssid_id) if ssid_id is not None else np.zeros(0, dtype=np.int64)
+
+    def rows_in_cell(self, cell: Cell) -> np.ndarray:
+        with self.lock:
+            return self._by_cell.get(tuple(cell))
+
+    def _filter_mac(self, rows: np.ndarray, mac: Optional[str]) -> np.ndarray:
+        if mac is None:
+            return rows
+        mac_id = self.store.macs.ids.get(str(mac).rjust(12, '0'))
+        if mac_id is None:
+            return rows[:0]
+        return rows[self._column('mac')[rows] == mac_id]
+
+    def within(self, point: Sequence[float], radius: float, mac: Optional[str] = None) -> np.ndarray:
+        # Rows (ascending) measured within radius meters of point, optionally only those of one MAC
+        with self.lock:
+            low = self.cell_of([value - radius for value in point])
+            high = self.cell_of([value + radius for value in point])
+            # Whichever is less: the cells covering the sphere, or the occupied cells
+            if math.prod(h - lo + 1 for lo, h in zip(low, high)) <= len(self._by_cell.chunks):
+                cells = product(*(range(lo, h + 1) for lo, h in zip(low, high)))
+            else:
+                cells = [cell for cell in self._by_cell.keys()
+                         if all(low[axis] <= cell[axis] <= high[axis] for axis in range(3))]
+            candidates = [self._by_cell.get(cell) for cell in cells if cell in self._by_cell.chunks]
+            if not candidates:
+                return np.zeros(0, dtype=np.int64)
+            rows = self._filter_mac(np.sort(np.concatenate(candidates)), mac)
+            distances = np.linalg.norm(self._positions(rows) - np.asarray(point, dtype=np.float64), axis=1)
+            return rows[distances <= radius]
+
+    def nearest(self, point: Sequence[float], k: int = 1, mac: Optional[str] = None) -> np.ndarray:
+        # The k rows measured closest to point (closest first), optionally only those of one MAC. The search radius
+        # doubles until k rows are found within it, so only the cells around point are read.
+        with self.lock:
+            if self.indexed == 0:
+                return np.zeros(0, dtype=np.int64)
+            extent = np.linalg.norm(np.maximum(np.abs(self._high - point), np.abs(self._low - point)))
+            radius = self.cell_size
+            while True:
+                rows = self.within(point, radius, mac)
+                if len(rows) >= k or radius > extent:
+                    break
+                radius *= 2
+            distances = np.linalg.norm(self._positions(rows) - np.asarray(point, dtype=np.float64), axis=1)
+            return rows[np.argsort(distances, kind='stable')[:k]]
+
+    def group_by_cell(self, mac: Optional[str] = None) -> Dict[Cell, np.ndarray]:
+        # Rows per grid cell, optionally only those of one MAC, cells without rows are left out
+        with self.lock:
+            groups = {}
+            for cell in self._by_cell.keys():
+                rows = self._filter_mac(self._by_cell.get(cell), mac)
+                if len(rows):
+                    groups[cell] = rows
+            return groups
+
+    def strongest_per_cell(self) -> Dict[Cell, Tuple[str, int]]:
+        # (MAC, RSSI) of the strongest reading in every grid cell
+        with self.lock:
+            rssi = self._column('rssi')
+            mac_ids = self._column('mac')
+            strongest = {}
+            for cell, rows in self.group_by_cell().items():
+                row = rows[np.argmax(rssi[rows])]
+                strongest[cell] = (self.store.macs[int(mac_ids[row])], int(rssi[row]))
+            return strongest
@@ -0,0 +1,181 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import List, Optional
+
+from .aggregate import VoxelAggregator
+from .utils import Measurement, obfuscate_mac
+
+logger = logging.getLogger("rembuilder")
+
+LIVE_HOST = "127.0.0.1"  # Only reachable from this machine
+LIVE_PORT = 8765
+KEEP_ALIVE_PERIOD = 15  # Number of seconds after which an idle event stream gets a comment, to keep it open
+CLIENT_QUEUE_SIZE = 1000  # Events buffered per client, a client that falls this far behind is dropped
+
+
+class _LiveRequestHandler(BaseHTTPRequestHandler):
+    server: '_LiveHTTPServer'
+
+    def log_message(self, format, *args):
+        logger.debug(f"Live server: {format % args}")
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        live = self.server.live
+        path = self.path.split('?', 1)[0]
+        if path == '/events':
+            self._stream(live)
+        elif path == '/snapshot':
+            self._send(200, 'application/json', json.dumps(live.snapshot()).encode())
+        else:
+            self._send(404, 'text/plain', b"Use /events (server-sent events) or /snapshot\n")
+
+    def _stream(self, live: 'LiveServer'):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        queue = live.subscribe()
+        try:
+            while not live.stopped.is_set():
+                try:
+                    message = queue.get(timeout=KEEP_ALIVE_PERIOD)
+                except Empty:
+                    message = ": keep-alive\n\n"
+                if message is None:
+                    break
+                self.wfile.write(message.encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            live.unsubscribe(queue)
+
+
+class _LiveHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, live: 'LiveServer'):
+        super().__init__(address, _LiveRequestHandler)
+        self.live = live
+
+
+# Pushes the progress of a mission to dashboards on this machine as server-sent events on /events:
+#   event: scan   {"drone", "time", "position", "aps": [{"mac", "ssid", "rssi", "chn"}]} for every completed scan
+#   event: cells  {"voxel_size", "cells": [{"voxel", "center", "mac", "count", "mean", "std", "min", "max"}]} with
+#                 only the voxel/AP cells of an aggregator that changed with the last scan
+# /snapshot returns all cells of the aggregator, for clients that join during a mission.
+class LiveServer:
+    def __init__(self, port: int = LIVE_PORT, aggregator: Optional[VoxelAggregator] = None):
+        self.aggregator = aggregator
+        self.stopped = Event()
+        self._clients: List[Queue] = []
+        self._clients_lock = Lock()
+        self._server = _LiveHTTPServer((LIVE_HOST, port), self)
+        self.port = self._server.server_address[1]
+        self._thread = Thread(target=self._server.serve_forever, name="live-server", daemon=True)
+        if aggregator is not None:
+            aggregator.listeners.append(self.publish_cells)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Live view on http://{LIVE_HOST}:{self.port}/events")
+
+    def stop(self):
+        self.stopped.set()
+        with self._clients_lock:
+            for queue in list(self._clients):
+                self._put(queue, None)
+        self._server.shutdown()
+        self._server.server_close()
+
+    def subscribe(self) -> Queue:
+        queue = Queue(CLIENT_QUEUE_SIZE)
+        with self._clients_lock:
+            self._clients.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: Queue):
+        with self._clients_lock:
+            if queue in self._clients:
+                self._clients.remove(queue)
+
+    def _put(self, queue: Queue, message: Optional[str]):
+        # Called with _clients_lock held
+        try:
+            queue.put_nowait(message)
+        except Full:
+            # A stalled client must not hold up the mission, it gets disconnected instead. The queue is emptied through
+            # its own (locked) methods since the handler thread may be reading from it, then the handler is stopped.
+            if queue in self._clients:
+                self._clients.remove(queue)
+            try:
+                while True:
+                    queue.get_nowait()
+            except Empty:
+                pass
+            queue.put_nowait(None)
+            logger.warning("Live server: dropped a client that could not keep up")
+
+    def publish(self, event: str, data: dict):
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        with self._clients_lock:
+            for queue in list(self._clients):
+                self._put(queue, message)
+
+    def attach(self, drone):
+        # Publishes the scans of a ScanningDrone
+        tag = drone.link
+        drone.printer.scan_listeners.append(lambda scan: self.publish_scan(tag, scan))
+
+    def publish_scan(self, drone: str, scan):
+        if not scan:
+            return
+        first = scan[0]
+        self.publish('scan', {
+            'drone': drone,
+            'time': first.timestamp.isoformat(),
+            'position': [first.x, first.y, first.z],
+            'aps': [{'mac': m.get_mac(), 'ssid': m.ssid, 'rssi': m.rssi, 'chn': m.chn} for m in scan],
+        })
+
+    def _cell(self, voxel, mac, stats) -> dict:
+        return {
+            'voxel': list(voxel),
+            'center': list(self.aggregator.voxel_center(voxel)),
+            'mac': obfuscate_mac(mac) if Measurement.obfuscate_mac_address else mac,
+            'count': stats.count,
+            'mean': stats.mean,
+            'std': stats.std,
+            'min': stats.min,
+            'max': stats.max,
+        }
+
+    def publish_cells(self, changed):
+        self.publish('cells', {
+            'voxel_size': self.aggregator.voxel_size,
+            'cells': [self._cell(voxel, mac, stats) for voxel, mac, stats in changed],
+        })
+
+    def snapshot(self) -> dict:
+        if self.aggregator is None:
+            return {'voxel_size': None, 'cells': []}
+        return {
+            'voxel_size': self.aggregator.voxel_size,
+            'scans': self.aggregator.scan_count,
+            'measurements': self.aggregator.measurement_count,
+            'cells': [self._cell(voxel, mac, stats) for voxel, mac, stats in self.aggregator.snapshot()],
+        }
@@ -0,0 +1,138 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import time
+
+from threading import Lock, Thread
+from typing import Dict, Tuple
+
+from .aggregate import RunningStats
+
+logger = logging.getLogger("rembuilder")
+
+METRICS_HOST = "127.0.0.1"  # Only reachable from this machine
+METRICS_PORT = 9108
+PREFIX = "rembuilder_"
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, object]) -> Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{label}="{_escape(value)}"' for label, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+# Counters and summaries (count, sum, mean, std, min, max) of the mission, keyed by name and labels, e.g.
+#   metrics.observe('goto_seconds', 1.2, drone='0_80_2M_E7E7E7E7E7')
+# Everything uses the shared METRICS registry unless given another one.
+class Metrics:
+    def __init__(self):
+        self._lock = Lock()
+        self.counters: Dict[Key, float] = {}
+        self.summaries: Dict[Key, RunningStats] = {}
+        self.created = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            stats = self.summaries.get(key)
+            if stats is None:
+                stats = self.summaries[key] = RunningStats()
+            stats.add(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.summaries.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            summaries = [{'name': name, 'labels': dict(labels), 'count': stats.count, 'sum': stats.mean * stats.count,
+                          'mean': stats.mean, 'std': stats.std, 'min': stats.min, 'max': stats.max}
+                         for (name, labels), stats in sorted(self.summaries.items())]
+        return {'created': self.created, 'exported': time.time(), 'counters': counters, 'summaries': summaries}
+
+    def save(self, filename: str):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=2)
+        logger.info(f"Metrics written to {filename}")
+
+    def prometheus_text(self) -> str:
+        # Prometheus text exposition format, summaries as <name>_count/_sum plus _min/_max gauges
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            summaries = sorted((key, stats.copy()) for key, stats in self.summaries.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}{_label_text(labels)} {value}")
+        for (name, labels), stats in summaries:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} summary")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}_count{_label_text(labels)} {stats.count}")
+            lines.append(f"{PREFIX}{name}_sum{_label_text(labels)} {stats.mean * stats.count}")
+            lines.append(f"{PREFIX}{name}_min{_label_text(labels)} {stats.min}")
+            lines.append(f"{PREFIX}{name}_max{_label_text(labels)} {stats.max}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics server: {format % args}")
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Serves a Metrics registry on http://127.0.0.1:<port>/metrics for Prometheus to scrape
+class MetricsServer:
+    def __init__(self, port: int = METRICS_PORT, metrics: Metrics = METRICS):
+        self._server = ThreadingHTTPServer((METRICS_HOST, port), _MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._server.metrics = metrics
+        self.port = self._server.server_address[1]
+        self._thread = Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Metrics on http://{METRICS_HOST}:{self.port}/metrics")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
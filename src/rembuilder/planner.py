@@ -0,0 +1,137 @@
+import logging
+import math
+
+from typing import List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger("rembuilder")
+
+Point = Tuple[float, float, float]
+StartPose = Tuple[float, float, float, float]  # x, y, z, yaw (degrees)
+Waypoint = Tuple[float, float, float, float, bool]  # dx, dy, dz, yaw, scan as used by ScanningDrone.scan_waypoints
+
+WALL_MARGIN = 0.3  # Minimum distance in meters between a scan position and the walls of the volume
+LANDING_HEIGHT = 0.25  # Height relative to the start position of the last waypoint before the motors are stopped
+MAX_2OPT_ROUNDS = 50
+
+
+def grid_points(volume, resolution: Union[float, Sequence[float]], margin: float = WALL_MARGIN) -> List[Point]:
+    # Regular grid of scan positions inside volume, centered so that the leftover space is split evenly between
+    # both walls of every axis
+    if isinstance(resolution, (int, float)):
+        resolution = (resolution,) * 3
+
+    axes = []
+    for (low, high), step in zip(volume, resolution):
+        span = high - low - 2 * margin
+        count = int(math.floor(span / step + 1e-9)) + 1 if span >= 0 else 1
+        first = low + (high - low - (count - 1) * step) / 2
+        axes.append([round(first + i * step, 3) for i in range(count)])
+
+    return [(x, y, z) for z in axes[2] for y in axes[1] for x in axes[0]]
+
+
+def split_points(points: List[Point], starts: List[StartPose]) -> List[List[Point]]:
+    # Gives every drone an equally sized, contiguous part of each layer. Layers are cut along the horizontal axis on
+    # which the start positions are furthest apart, and the parts are handed out in the order of the start positions
+    # along that axis, so every drone works on the area it starts next to.
+    if len(starts) == 1:
+        return [list(points)]
+
+    axis = 0 if (max(s[0] for s in starts) - min(s[0] for s in starts)
+                 >= max(s[1] for s in starts) - min(s[1] for s in starts)) else 1
+    other = 1 - axis
+    drone_order = sorted(range(len(starts)), key=lambda i: starts[i][axis])
+
+    assigned: List[List[Point]] = [[] for _ in starts]
+    for z in sorted({p[2] for p in points}):
+        layer = sorted((p for p in points if p[2] == z), key=lambda p: (p[axis], p[other]))
+        for rank, drone in enumerate(drone_order):
+            assigned[drone].extend(layer[rank * len(layer) // len(starts):(rank + 1) * len(layer) // len(starts)])
+    return assigned
+
+
+def path_length(start: Point, points: Sequence[Point]) -> float:
+    length = 0.0
+    previous = start
+    for point in points:
+        length += math.dist(previous, point)
+        previous = point
+    return length
+
+
+def order_route(start: Point, points: List[Point], end: Optional[Point] = None) -> List[Point]:
+    # Nearest neighbour tour from start, improved with 2-opt moves. The route starts at start and, if given, ends at
+    # end (neither is part of the result), otherwise it may end anywhere.
+    remaining = list(points)
+    route = []
+    current = start
+    while remaining:
+        nearest = min(range(len(remaining)), key=lambda i: math.dist(current, remaining[i]))
+        current = remaining.pop(nearest)
+        route.append(current)
+
+    path = [start] + route + ([end] if end is not None else [])
+    n = len(path)
+    last = n - 1 if end is not None else n
+    for _ in range(MAX_2OPT_ROUNDS):
+        improved = False
+        for i in range(1, last - 1):
+            for j in range(i + 1, last):
+                # Reversing path[i..j] replaces edges (i-1, i) and (j, j+1) by (i-1, j) and (i, j+1)
+                before = math.dist(path[i - 1], path[i])
+                after = math.dist(path[i - 1], path[j])
+                if j + 1 < n:
+                    before += math.dist(path[j], path[j + 1])
+                    after += math.dist(path[i], path[j + 1])
+                if after < before - 1e-9:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    improved = True
+        if not improved:
+            break
+    return path[1:last]
+
+
+def plan_route(start: StartPose, points: List[Point]) -> List[Waypoint]:
+    # Visits the layers from the bottom up so the drone changes height as few times as possible, each layer is
+    # ordered separately starting from where the previous layer ended. Returns waypoints relative to the start pose,
+    # including take-off and landing.
+    sx, sy, sz, _ = start
+    layers = sorted({p[2] for p in points})
+    if not layers:
+        return []
+
+    current = (sx, sy, layers[0])
+    route = [current]
+    waypoints: List[Waypoint] = [(0.0, 0.0, round(layers[0] - sz, 3), 0.0, False)]  # take-off
+    for z in layers:
+        # The last layer is ordered so that it ends close to the way home
+        end = (sx, sy, z) if z == layers[-1] else None
+        ordered = order_route(current, [p for p in points if p[2] == z], end)
+        for x, y, _ in ordered:
+            waypoints.append((round(x - sx, 3), round(y - sy, 3), round(z - sz, 3), 0.0, True))
+        route.extend(ordered)
+        current = ordered[-1]
+
+    # Return above the start position, then descend
+    waypoints.append((0.0, 0.0, round(current[2] - sz, 3), 0.0, False))
+    waypoints.append((0.0, 0.0, LANDING_HEIGHT, 0.0, False))
+    route.append((sx, sy, current[2]))
+    logger.debug(f"Planned {len(waypoints)} waypoints, {path_length(route[0], route[1:]):.2f}m in flight")
+    return waypoints
+
+
+def plan_mission(volume, resolution: Union[float, Sequence[float]], starts: List[StartPose],
+                 margin: float = WALL_MARGIN) -> List[List[Waypoint]]:
+    # One waypoint sequence per start pose, covering a scan grid over volume together
+    assigned = split_points(grid_points(volume, resolution, margin), starts)
+    return [plan_route(start, points) for start, points in zip(starts, assigned)]
+
+
+def plan_drones(drones: List[dict], volume, resolution: Union[float, Sequence[float]],
+                margin: float = WALL_MARGIN) -> List[dict]:
+    # Fills in the "sequence" of drone configurations in the format used in main.py
+    starts = [(d["start_x"], d["start_y"], d["start_z"], d["start_yaw"]) for d in drones]
+    for drone, sequence in zip(drones, plan_mission(volume, resolution, starts, margin)):
+        drone["sequence"] = sequence
+        logger.info(f"{drone['uri']}: {sum(1 for w in sequence if w[4])} scan positions planned")
+    return drones
@@ -0,0 +1,162 @@
+import logging
+
+from threading import Event, Lock, Thread
+from typing import Callable, List
+
+from .clock import SYSTEM_CLOCK
+from .metrics import METRICS
+
+logger = logging.getLogger("rembuilder")
+
+RADIO_SHUTDOWN_PERIOD = 3  # Initial number of seconds to shutdown the radio, before any scan has been observed
+MIN_RADIO_SHUTDOWN_PERIOD = 1  # Never keep the radio off for less than this number of seconds
+MAX_RADIO_SHUTDOWN_PERIOD = 10  # Never keep the radio off for more than this number of seconds
+RECONNECT_TIMEOUT = 10  # Number of seconds to wait for the link to come back after the radio silence
+WINDOW_MARGIN = 1.2  # The radio silence is this much longer than the expected scan duration
+SMOOTHING = 0.3  # Weight of a new observation in the running scan duration estimate
+GROWTH = 1.5  # Factor by which the estimate grows when a scan outlasted the radio silence
+SHRINK = 0.95  # Factor by which the estimate shrinks when a scan fitted in the radio silence
+CONSOLE_SLACK = 0.5  # Seconds after reconnecting in which buffered console output is still being delivered
+
+
+class ScanWindowEstimator:
+    # Running estimate of how long an ESP8266 scan takes, used to size the radio silence.
+    #
+    # While the radio is off the console output is held back by the Crazyflie, so a scan only has a reliable duration
+    # when it ended while the link was up again. Otherwise all we learn is whether the scan fitted in the window: if
+    # it did the estimate is slowly shrunk towards the real duration, if it did not it is grown quickly.
+    def __init__(self, initial: float = RADIO_SHUTDOWN_PERIOD):
+        self.estimate = initial / WINDOW_MARGIN
+        self.observations = 0
+
+    @property
+    def window(self) -> float:
+        return min(MAX_RADIO_SHUTDOWN_PERIOD, max(MIN_RADIO_SHUTDOWN_PERIOD, self.estimate * WINDOW_MARGIN))
+
+    def observe(self, duration: float):
+        self.estimate += SMOOTHING * (duration - self.estimate)
+        self.observations += 1
+
+    def scan_fitted(self):
+        self.estimate *= SHRINK
+
+    def scan_outlasted(self, window: float):
+        self.estimate = max(self.estimate, window) * GROWTH
+
+
+# Runs the radio silence cycle (close link, wait, open link, wait for the connection) on its own thread, so the cflib
+# callback that asks for it returns immediately. Requests that come in while a cycle is running are ignored, a scan
+# that is still running after reconnecting gets another cycle.
+class RadioSilenceScheduler(Thread):
+    def __init__(self, name: str, close_link: Callable[[], None], open_link: Callable[[], None], connected: Event,
+                 estimator: ScanWindowEstimator = None, clock=SYSTEM_CLOCK, metrics=METRICS):
+        super().__init__(name=f"radio-{name}", daemon=True)
+        self._clock = clock
+        self._metrics = metrics
+        self._drone = name
+        self._close_link = close_link
+        self._open_link = open_link
+        self._connected = connected
+        self.estimator = estimator if estimator is not None else ScanWindowEstimator()
+
+        self._requested = Event()
+        self._stopped = Event()
+        self._lock = Lock()
+        self._busy = False
+        self._awaiting_report = False
+        self._last_window = None
+        self._repeat = False
+        self._scan_started = None
+        self.reconnected_at = None
+
+        self.windows: List[float] = []
+        self.reconnect_latencies: List[float] = []
+
+    def request(self):
+        with self._lock:
+            if self._busy:
+                return
+            self._busy = True
+        self._requested.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._requested.set()
+
+    def scan_state_reported(self, running: bool) -> bool:
+        # Called with every scanNow value, returns whether it was the first one read after the link came back
+        with self._lock:
+            if not self._awaiting_report:
+                return False
+            self._awaiting_report = False
+            if running:
+                self._busy = True
+                self._repeat = True
+                self._requested.set()
+
+        if running:
+            self.estimator.scan_outlasted(self._clock.time() - self._scan_started)
+            logger.debug(f"Scan outlasted the {self._last_window:.2f}s radio silence")
+        else:
+            self.estimator.scan_fitted()
+        return True
+
+    def scan_duration_observed(self, duration: float):
+        # Durations measured on the console are only real when the end of the scan came in while the link was up,
+        # not with the burst of buffered output that follows a radio silence
+        now = self._clock.time()
+        if self._busy or (self.reconnected_at is not None and now - self.reconnected_at < CONSOLE_SLACK):
+            return
+        self.estimator.observe(duration)
+
+    def run(self) -> None:
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+            if self._stopped.is_set():
+                break
+            with self._lock:
+                self._busy = True
+            try:
+                self._silence()
+            except Exception:
+                logger.exception("Radio silence cycle failed")
+            finally:
+                with self._lock:
+                    self._busy = self._requested.is_set()
+
+    def _silence(self):
+        # A scan that outlasted the previous silence only needs what is left of the (now larger) estimate
+        window = self.estimator.window
+        repeat = self._repeat
+        if repeat:
+            self._repeat = False
+            window = max(MIN_RADIO_SHUTDOWN_PERIOD, window - (self._clock.time() - self._scan_started))
+        else:
+            self._scan_started = self._clock.time()
+        self._last_window = window
+        self.windows.append(window)
+        self._metrics.inc('radio_silences_total', drone=self._drone, repeat=repeat)
+
+        logger.info(f"Shutting down radio for {window:.2f}s while scanning")
+        closed = self._clock.time()
+        self._close_link()
+        stopped = self._clock.wait(self._stopped, window)
+        self._metrics.observe('radio_silence_seconds', self._clock.time() - closed, drone=self._drone)
+        if stopped:
+            return
+
+        logger.info("Starting radio again")
+        with self._lock:
+            self._awaiting_report = True
+        started = self._clock.time()
+        self._open_link()
+        if self._clock.wait(self._connected, RECONNECT_TIMEOUT):
+            self.reconnected_at = self._clock.time()
+            latency = self.reconnected_at - started
+            self.reconnect_latencies.append(latency)
+            self._metrics.observe('radio_reconnect_seconds', latency, drone=self._drone)
+            logger.debug(f"Reconnected after {latency:.2f}s")
+        else:
+            self._metrics.inc('radio_reconnect_failures_total', drone=self._drone)
+            logger.error(f"Link did not come back within {RECONNECT_TIMEOUT}s after radio silence")
@@ -0,0 +1,280 @@
+import logging
+import time
+
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from .store import MeasurementStore
+from .utils import Measurement, normalize_rssi
+
+logger = logging.getLogger("rembuilder")
+
+Volume = Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]]
+
+IDW = "idw"
+KRIGING = "kriging"
+MIN_DISTANCE = 1e-9  # Voxels closer than this (in meters) to a scan position simply take its value
+MAX_VARIOGRAM_PAIRS = 200000  # Position pairs sampled when fitting the variogram
+MAX_VARIOGRAM_APS = 64  # Access points (the most observed ones) used when fitting the variogram
+VOXEL_CHUNK = 65536  # Voxels per batch when solving the kriging systems
+AP_CHUNK = 256  # Access points per batch when applying the interpolation weights
+
+
+def as_store(measurements: Union[MeasurementStore, Iterable[Measurement]]) -> MeasurementStore:
+    if isinstance(measurements, MeasurementStore):
+        return measurements
+    store = MeasurementStore()
+    store.extend(measurements)
+    return store
+
+
+def make_axes(volume: Volume, resolution: Union[float, Sequence[float]]) -> List[np.ndarray]:
+    # Voxel centers along each axis, the outer voxels touch the walls of the volume
+    if np.isscalar(resolution):
+        resolution = (resolution,) * 3
+    axes = []
+    for (low, high), step in zip(volume, resolution):
+        count = max(1, int(round((high - low) / step)))
+        step = (high - low) / count
+        axes.append(low + step * (np.arange(count) + 0.5))
+    return axes
+
+
+def scan_table(store: MeasurementStore, macs: Optional[Sequence[str]] = None):
+    # Collapses the measurements into one row per distinct scan position and one column per access point. Repeated
+    # readings of the same AP at the same position are averaged. Returns (positions (P, 3), values (P, A), observed
+    # (P, A), mac strings).
+    x = np.frombuffer(store.x, dtype=np.float64)
+    y = np.frombuffer(store.y, dtype=np.float64)
+    z = np.frombuffer(store.z, dtype=np.float64)
+    mac_ids = np.frombuffer(store.mac, dtype=np.uint32)
+    signal = normalize_rssi(np.frombuffer(store.rssi, dtype=np.int8).astype(np.float64)).clip(0.0, 1.0)
+
+    if macs is not None:
+        wanted = np.array([store.macs.ids.get(str(mac).rjust(12, '0'), -1) for mac in macs], dtype=np.int64)
+        column_of = np.full(len(store.macs), -1, dtype=np.int64)
+        column_of[wanted[wanted >= 0]] = np.nonzero(wanted >= 0)[0]
+        columns = column_of[mac_ids]
+        keep = columns >= 0
+        x, y, z, signal, columns = x[keep], y[keep], z[keep], signal[keep], columns[keep]
+        mac_names = [str(mac).rjust(12, '0') for mac in macs]
+    else:
+        columns = mac_ids.astype(np.int64)
+        mac_names = list(store.macs.strings)
+
+    positions, position_index = np.unique(np.stack([x, y, z], axis=1), axis=0, return_inverse=True)
+    position_index = position_index.reshape(-1)
+    n_positions, n_aps = len(positions), len(mac_names)
+
+    flat = position_index * n_aps + columns
+    sums = np.bincount(flat, weights=signal, minlength=n_positions * n_aps)
+    counts = np.bincount(flat, minlength=n_positions * n_aps)
+    observed = (counts > 0).reshape(n_positions, n_aps)
+    # bincount gives integers instead of floats for an empty store
+    values = np.divide(sums, counts, out=np.zeros(len(sums)), where=counts > 0).reshape(n_positions, n_aps)
+    return positions, values, observed, mac_names
+
+
+def exponential_variogram(h, nugget: float, psill: float, range_: float):
+    return nugget + psill * (1.0 - np.exp(-3.0 * h / range_))
+
+
+def fit_variogram(positions: np.ndarray, values: np.ndarray, observed: np.ndarray, n_bins: int = 12,
+                  rng: Optional[np.random.Generator] = None) -> Tuple[float, float, float]:
+    # Fits one exponential variogram (nugget, partial sill, range) on the pooled semivariances of the most observed
+    # access points. Sharing the model between APs keeps the kriging weights purely geometric, so they only have to
+    # be solved once for all APs.
+    rng = rng if rng is not None else np.random.default_rng(0)
+    n_positions = len(positions)
+    if n_positions < 3:
+        return 0.0, 1.0, 1.0
+
+    top = np.argsort(observed.sum(axis=0))[::-1][:MAX_VARIOGRAM_APS]
+    values, observed = values[:, top], observed[:, top]
+
+    n_pairs = min(MAX_VARIOGRAM_PAIRS, n_positions * (n_positions - 1) // 2)
+    i = rng.integers(0, n_positions, n_pairs)
+    j = rng.integers(0, n_positions, n_pairs)
+    keep = i != j
+    i, j = i[keep], j[keep]
+
+    distance = np.linalg.norm(positions[i] - positions[j], axis=1)
+    both = observed[i] & observed[j]
+    semivariance = np.where(both, 0.5 * (values[i] - values[j]) ** 2, 0.0).sum(axis=1)
+    pair_counts = both.sum(axis=1)
+
+    edges = np.linspace(0.0, distance.max(), n_bins + 1)
+    bins = np.clip(np.digitize(distance, edges) - 1, 0, n_bins - 1)
+    bin_counts = np.bincount(bins, weights=pair_counts, minlength=n_bins)
+    gamma = np.bincount(bins, weights=semivariance, minlength=n_bins)
+    valid = bin_counts > 0
+    if valid.sum() < 2:
+        return 0.0, max(float(gamma.sum() / max(bin_counts.sum(), 1)), 1e-6), float(distance.max() or 1.0)
+    lags = 0.5 * (edges[:-1] + edges[1:])[valid]
+    gamma = gamma[valid] / bin_counts[valid]
+    weights = np.sqrt(bin_counts[valid])
+
+    # For a fixed range the model is linear in nugget and partial sill, so only the range needs a search
+    best = None
+    for range_ in np.linspace(lags[0], 2.0 * lags[-1], 40):
+        design = np.stack([np.ones_like(lags), 1.0 - np.exp(-3.0 * lags / range_)], axis=1)
+        coefficients, *_ = np.linalg.lstsq(design * weights[:, None], gamma * weights, rcond=None)
+        nugget, psill = np.maximum(coefficients, [0.0, 1e-9])
+        error = np.sum(weights * (design @ [nugget, psill] - gamma) ** 2)
+        if best is None or error < best[0]:
+            best = (error, float(nugget), float(psill), float(range_))
+    return best[1], best[2], best[3]
+
+
+def idw_weights(distances: np.ndarray, power: float) -> np.ndarray:
+    weights = 1.0 / np.maximum(distances, MIN_DISTANCE) ** power
+    exact = distances < MIN_DISTANCE
+    hit = exact.any(axis=1)
+    weights[hit] = exact[hit]
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def kriging_weights(positions: np.ndarray, distances: np.ndarray, neighbours: np.ndarray,
+                    variogram: Tuple[float, float, float]):
+    # Local ordinary kriging: one (k+1)x(k+1) system per voxel, solved in batches. Returns the weights and the
+    # kriging variance of every voxel.
+    nugget, psill, range_ = variogram
+    n_voxels, k = neighbours.shape
+    weights = np.empty((n_voxels, k))
+    variance = np.empty(n_voxels)
+
+    for start in range(0, n_voxels, VOXEL_CHUNK):
+        stop = min(start + VOXEL_CHUNK, n_voxels)
+        local = positions[neighbours[start:stop]]
+        pairwise = np.linalg.norm(local[:, :, None, :] - local[:, None, :, :], axis=-1)
+
+        system = np.ones((stop - start, k + 1, k + 1))
+        system[:, :k, :k] = exponential_variogram(pairwise, nugget, psill, range_)
+        system[:, :k, :k][:, np.arange(k), np.arange(k)] = 0.0
+        system[:, k, k] = 0.0
+        rhs = np.ones((stop - start, k + 1))
+        rhs[:, :k] = exponential_variogram(distances[start:stop], nugget, psill, range_)
+        rhs[:, :k][distances[start:stop] < MIN_DISTANCE] = 0.0
+
+        # Coinciding neighbours make the system singular, a tiny jitter on the diagonal keeps it solvable
+        system[:, np.arange(k), np.arange(k)] -= 1e-9 * max(psill, 1e-9)
+        solution = np.linalg.solve(system, rhs[:, :, None])[:, :, 0]
+        weights[start:stop] = solution[:, :k]
+        variance[start:stop] = np.maximum((solution * rhs).sum(axis=1), 0.0)
+
+    return weights, variance
+
+
+class RadioEnvironmentMap:
+    # Per access point 3D grid of normalized signal strength (see normalize_rssi), values has shape (A, nx, ny, nz)
+    def __init__(self, axes: List[np.ndarray], macs: List[str], values: np.ndarray,
+                 variance: Optional[np.ndarray] = None, method: str = IDW):
+        self.axes = axes
+        self.macs = macs
+        self.values = values
+        self.variance = variance
+        self.method = method
+        self._mac_index = {mac: index for index, mac in enumerate(macs)}
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return tuple(len(axis) for axis in self.axes)
+
+    def __getitem__(self, mac: str) -> np.ndarray:
+        return self.values[self._mac_index[str(mac).rjust(12, '0')]]
+
+    def __contains__(self, mac: str) -> bool:
+        return str(mac).rjust(12, '0') in self._mac_index
+
+    def rssi(self, mac: str) -> np.ndarray:
+        # Inverse of normalize_rssi
+        return self[mac] * 90.0 - 100.0
+
+    def strongest(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Index of the strongest access point and its normalized signal for every voxel
+        best = np.nanargmax(np.nan_to_num(self.values, nan=-np.inf), axis=0)
+        return best, np.take_along_axis(self.values, best[None], axis=0)[0]
+
+    def save(self, filename: str):
+        extra = {} if self.variance is None else {'variance': self.variance}
+        np.savez_compressed(filename, xs=self.axes[0], ys=self.axes[1], zs=self.axes[2], macs=np.array(self.macs),
+                            values=self.values, method=np.array(self.method), **extra)
+
+    @classmethod
+    def load(cls, filename: str) -> 'RadioEnvironmentMap':
+        with np.load(filename) as data:
+            variance = data['variance'] if 'variance' in data else None
+            return cls([data['xs'], data['ys'], data['zs']], [str(mac) for mac in data['macs']], data['values'],
+                       variance, str(data['method']))
+
+
+def build_rem(measurements: Union[MeasurementStore, Iterable[Measurement]], volume: Volume,
+              resolution: Union[float, Sequence[float]] = 0.1, method: str = IDW, k: int = 8, power: float = 2.0,
+              fill_missing: bool = True, macs: Optional[Sequence[str]] = None,
+              variogram: Optional[Tuple[float, float, float]] = None) -> RadioEnvironmentMap:
+    # Interpolates the measurements onto a voxel grid covering volume, one grid per access point.
+    #
+    # All access points are interpolated at once: the neighbour lookup and the weights only depend on the scan
+    # positions, so they are computed once as a sparse (voxels x positions) matrix and applied to the
+    # (positions x APs) value table with a single sparse matrix product.
+    #
+    # With fill_missing an AP that was not heard at a scan position counts as the weakest possible signal there,
+    # otherwise the weights are renormalized over the positions where the AP was heard (voxels with no such
+    # neighbour become NaN).
+    started = time.perf_counter()
+    store = as_store(measurements)
+    if len(store) == 0:
+        raise ValueError("No measurements to build a radio environment map from")
+    positions, values, observed, mac_names = scan_table(store, macs)
+    if len(positions) == 0:
+        raise ValueError("No measurements to build a radio environment map from")
+
+    axes = make_axes(volume, resolution)
+    grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    k = min(k, len(positions))
+
+    distances, neighbours = cKDTree(positions).query(grid, k=k)
+    distances = distances.reshape(len(grid), k)
+    neighbours = neighbours.reshape(len(grid), k)
+
+    variance = None
+    if method == IDW:
+        weights = idw_weights(distances, power)
+    elif method == KRIGING:
+        if variogram is None:
+            variogram = fit_variogram(positions, values, observed)
+            logger.debug(f"Fitted variogram nugget={variogram[0]:.4g} sill={variogram[1]:.4g} range={variogram[2]:.3g}")
+        weights, variance = kriging_weights(positions, distances, neighbours, variogram)
+        variance = variance.reshape([len(axis) for axis in axes]).astype(np.float32)
+    else:
+        raise ValueError(f"Unknown interpolation method {method}")
+
+    rows = np.repeat(np.arange(len(grid)), k)
+    matrix = sparse.csr_matrix((weights.ravel().astype(np.float32), (rows, neighbours.ravel())),
+                               shape=(len(grid), len(positions)))
+
+    # The result is assembled per block of access points, so the peak memory stays close to the size of the map
+    shape = tuple(len(axis) for axis in axes)
+    result = np.empty((len(mac_names), len(grid)), dtype=np.float32)
+    for start in range(0, len(mac_names), AP_CHUNK):
+        stop = min(start + AP_CHUNK, len(mac_names))
+        block = values[:, start:stop].astype(np.float32)
+        if fill_missing:
+            result[start:stop] = (matrix @ block).T
+        else:
+            mask = observed[:, start:stop].astype(np.float32)
+            numerator = matrix @ (block * mask)
+            denominator = matrix @ mask
+            result[start:stop] = np.divide(numerator, denominator, out=np.full_like(numerator, np.nan),
+                                           where=np.abs(denominator) > MIN_DISTANCE).T
+
+    values = result.reshape(len(mac_names), *shape)
+    if method == KRIGING:
+        np.clip(values, 0.0, 1.0, out=values)
+
+    logger.info(f"Built {method} REM for {len(mac_names)} access points over {len(grid)} voxels from "
+                f"{len(positions)} scan positions in {time.perf_counter() - started:.2f}s")
+    return RadioEnvironmentMap(axes, mac_names, values, variance, method)
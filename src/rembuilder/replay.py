@@ -0,0 +1,110 @@
+from datetime import datetime
+import logging
+import re
+import time
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("rembuilder")
+
+# Lines of the *_console_debug.out files written by main.py, e.g.
+# 2021-05-01 14:03:12,345 [rembuilder] [DEBUG] CF[0_80_2M_E7E7E7E7E7]: AP: eduroam, -67, a0b1c2d3e4f5, 6
+# Logs from before the drone tag was added have "CF: " instead
+PTN_DEBUG_LOG = re.compile(r'^(?P<time>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) \[[^\]]*\] \[DEBUG\] '
+                           r'CF(?:\[(?P<tag>[^\]]*)\])?: (?P<line>.*)$')
+PTN_LOG_PREFIX = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} \[')
+PACKET_SIZE = 30  # Console text arrives in CRTP packets of at most this many characters
+
+
+class ReplayCaller:
+    # Minimal stand-in for cflib.utils.callbacks.Caller
+    def __init__(self):
+        self.callbacks: List[Callable] = []
+
+    def add_callback(self, cb: Callable):
+        if cb not in self.callbacks:
+            self.callbacks.append(cb)
+
+    def remove_callback(self, cb: Callable):
+        self.callbacks.remove(cb)
+
+    def call(self, *args):
+        for cb in self.callbacks:
+            cb(*args)
+
+
+class ReplayConsole:
+    # Stand-in for Crazyflie.console, ConsolePrinter only needs its receivedChar callback source
+    def __init__(self):
+        self.receivedChar = ReplayCaller()
+
+
+def read_tagged_console_lines(filename: str) -> Iterator[Tuple[Optional[str], Optional[datetime], str]]:
+    # Yields (drone tag, time, console line) from a *_console_debug.out file. Files without log prefixes are treated
+    # as a raw console dump, their lines have no time. Lines without a drone tag (raw dumps, older logs) have None.
+    with open(filename, errors='replace') as fh:
+        for line in fh:
+            line = line.rstrip('\r\n')
+            mo = PTN_DEBUG_LOG.match(line)
+            if mo is not None:
+                yield mo.group('tag'), datetime.strptime(mo.group('time'), '%Y-%m-%d %H:%M:%S,%f'), mo.group('line')
+            elif PTN_LOG_PREFIX.match(line) is None:
+                yield None, None, line
+
+
+def split_consoles(filename: str) -> Dict[Optional[str], List[Tuple[Optional[datetime], str]]]:
+    # The debug log of a fleet holds the interleaved consoles of all its drones, which only make sense separately
+    consoles: Dict[Optional[str], List[Tuple[Optional[datetime], str]]] = {}
+    for tag, timestamp, line in read_tagged_console_lines(filename):
+        consoles.setdefault(tag, []).append((timestamp, line))
+    return consoles
+
+
+def read_console_lines(filename: str, drone: Optional[str] = None) -> Iterator[Tuple[Optional[datetime], str]]:
+    # Yields (time, console line) of a single console: the one of drone, or the only one in the file
+    seen = None
+    for tag, timestamp, line in read_tagged_console_lines(filename):
+        if drone is not None:
+            if tag == drone:
+                yield timestamp, line
+            continue
+        if tag is not None:
+            if seen is not None and tag != seen:
+                raise ValueError(f"{filename} holds the consoles of several drones ({seen}, {tag}), pick one")
+            seen = tag
+        yield timestamp, line
+
+
+class ReplayDriver:
+    # Feeds recorded console lines into a console's receivedChar callbacks, split in radio sized packets. With speed
+    # set, the recorded timing is reproduced (speed=1 is real-time, 10 is ten times faster), otherwise lines are sent
+    # as fast as possible.
+    def __init__(self, console: ReplayConsole, lines: Iterable[Tuple[Optional[datetime], str]],
+                 speed: Optional[float] = None, packet_size: int = PACKET_SIZE):
+        self.console = console
+        self.lines = lines
+        self.speed = speed
+        self.packet_size = packet_size
+        self.lines_sent = 0
+        self.chars_sent = 0
+        self.line_sent_times: List[float] = []
+        self.record_times = False
+
+    def run(self):
+        first_recorded = None
+        first_real = None
+        for timestamp, line in self.lines:
+            if self.speed and timestamp is not None:
+                if first_recorded is None:
+                    first_recorded, first_real = timestamp, time.perf_counter()
+                delay = (timestamp - first_recorded).total_seconds() / self.speed - (time.perf_counter() - first_real)
+                if delay > 0:
+                    time.sleep(delay)
+
+            text = line + '\n'
+            for start in range(0, len(text), self.packet_size):
+                self.console.receivedChar.call(text[start:start + self.packet_size])
+            if self.record_times:
+                self.line_sent_times.append(time.perf_counter())
+            self.lines_sent += 1
+            self.chars_sent += len(text)
@@ -0,0 +1,474 @@
+import argparse
+import logging
+import math
+import os
+import random
+
+from threading import Event, RLock, Thread
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .clock import ScaledClock
+from .replay import ReplayCaller as Caller
+
+logger = logging.getLogger("rembuilder")
+
+PHYSICS_STEP = 0.02  # Number of (simulated) seconds between updates of the simulated drone
+CONNECT_LATENCY = 0.3  # Number of seconds between opening a link and the connected callback
+PARAM_LATENCY = 0.02  # Number of seconds between setting a parameter and the update callback
+RESPONSE_TIME = 0.5  # Time constant in seconds of the simulated position controller
+MAX_SPEED = 1.0  # Maximum speed in meters per second of the simulated drone
+SCAN_DURATION = 2.2  # Average duration in seconds of a simulated ESP8266 scan
+SCAN_JITTER = 0.3  # Maximum deviation in seconds from the average scan duration
+VARIANCE_TIME_CONSTANT = 0.4  # Time constant in seconds with which the Kalman variance converges after a reset
+VARIANCE_FLOOR = 1e-4
+POSITION_NOISE = 0.002  # Standard deviation in meters of the simulated state estimate
+RSSI_NOISE = 3.0  # Standard deviation in dB of the simulated RSSI readings
+RSSI_CUTOFF = -95  # Weakest RSSI the ESP8266 still reports
+PACKET_SIZE = 30  # Console text is delivered in packets of at most this many characters
+LINK_OUTAGE = 2.0  # Number of seconds a simulated link loss lasts, connecting fails until it is over
+WIFI_CHANNELS = 13
+
+SIM_VOLUME = ((0.0, 3.74), (0.0, 2.30), (0.0, 2.10))
+SIM_STARTS = [(2.10, 0.15, -0.20, 45), (0.60, 0.15, -0.20, 45)]
+
+
+class SimulatedAccessPoint:
+    def __init__(self, ssid: str, mac: str, position: Tuple[float, float, float], tx_power: float, channel: int):
+        self.ssid = ssid
+        self.mac = mac
+        self.position = position
+        self.tx_power = tx_power  # RSSI at 1 meter
+        self.channel = channel
+
+    def rssi(self, position, rng: random.Random, exponent: float = 2.5) -> int:
+        distance = max(0.1, math.dist(self.position, position))
+        return int(round(self.tx_power - 10 * exponent * math.log10(distance) + rng.gauss(0, RSSI_NOISE)))
+
+
+def random_access_points(count: int = 40, volume=SIM_VOLUME, spread: float = 15.0,
+                         seed: int = 0) -> List[SimulatedAccessPoint]:
+    # Access points in and around the flight volume, most of them in neighbouring rooms
+    rng = random.Random(seed)
+    center = [(low + high) / 2 for low, high in volume]
+    access_points = []
+    for i in range(count):
+        position = tuple(c + rng.uniform(-spread, spread) for c in center)
+        access_points.append(SimulatedAccessPoint(f"sim-{i:03d}", f"{rng.getrandbits(48):x}", position,
+                                                  rng.uniform(-45, -30), rng.randint(1, WIFI_CHANNELS)))
+    return access_points
+
+
+class SimLogConfig:
+    # Stand-in for cflib.crazyflie.log.LogConfig
+    def __init__(self, name: str, period_in_ms: int):
+        self.name = name
+        self.period_in_ms = period_in_ms
+        self.variables: List[str] = []
+        self.data_received_cb = Caller()
+        self.started = False
+        self.cf = None
+        self.next_due = 0.0
+
+    def add_variable(self, name: str, fetch_as=None):
+        self.variables.append(name)
+
+    def start(self):
+        self.started = True
+        if self.cf is not None:
+            self.next_due = self.cf.clock.time()
+
+    def stop(self):
+        self.started = False
+
+    def delete(self):
+        self.stop()
+        if self.cf is not None:
+            self.cf.remove_log_config(self)
+
+
+class _SimParam:
+    def __init__(self, cf: 'SimulatedCrazyflie'):
+        self._cf = cf
+        self.values: Dict[str, str] = {
+            'esp8266.scanOnDemand': '0',
+            'esp8266.scanInterval': '5',
+            'esp8266.scanNow': '0',
+            'kalman.initialX': '0.0',
+            'kalman.initialY': '0.0',
+            'kalman.initialZ': '0.0',
+            'kalman.initialYaw': '0.0',
+            'kalman.resetEstimation': '0',
+        }
+        self._callbacks: List[Tuple[Optional[str], Optional[str], object]] = []
+
+    def add_update_callback(self, group=None, name=None, cb=None):
+        self._callbacks.append((group, name, cb))
+
+    def remove_update_callback(self, group, name=None, cb=None):
+        if (group, name, cb) in self._callbacks:
+            self._callbacks.remove((group, name, cb))
+
+    def set_value(self, complete_name: str, value):
+        self._cf.set_param(complete_name, str(value))
+
+    def notify(self, complete_name: str):
+        group, name = complete_name.split('.', 1)
+        for cb_group, cb_name, cb in list(self._callbacks):
+            if cb_group in (None, group) and cb_name in (None, name):
+                cb(complete_name, self.values[complete_name])
+
+
+class _SimCommander:
+    def __init__(self, cf: 'SimulatedCrazyflie'):
+        self._cf = cf
+
+    def send_position_setpoint(self, x, y, z, yaw):
+        self._cf.setpoint = (x, y, z)
+
+    def send_stop_setpoint(self):
+        self._cf.setpoint = None
+
+
+class _SimLog:
+    def __init__(self, cf: 'SimulatedCrazyflie'):
+        self._cf = cf
+
+    def add_config(self, log_config: SimLogConfig):
+        log_config.cf = self._cf
+        self._cf.add_log_config(log_config)
+
+
+class _SimConsole:
+    def __init__(self):
+        self.receivedChar = Caller()
+
+
+# A Crazyflie with an ESP8266 deck as seen through cflib: link callbacks, parameters, the commander, log blocks and
+# the console. A first order model of the position controller moves the drone towards its setpoint and a log-distance
+# path loss model produces the scan results. Everything runs on the given clock.
+class SimulatedCrazyflie:
+    def __init__(self, clock, access_points: List[SimulatedAccessPoint], rng: random.Random,
+                 scan_duration: float = SCAN_DURATION, link_drops: Sequence[float] = (),
+                 link_outage: float = LINK_OUTAGE):
+        self.clock = clock
+        self.access_points = access_points
+        self.rng = rng
+        self.scan_duration = scan_duration
+        self.link_drops = sorted(link_drops)  # Seconds after the first connection at which the link is lost
+        self.link_outage = link_outage
+
+        self.connected = Caller()
+        self.disconnected = Caller()
+        self.connection_failed = Caller()
+        self.connection_lost = Caller()
+        self.console = _SimConsole()
+        self.param = _SimParam(self)
+        self.commander = _SimCommander(self)
+        self.log = _SimLog(self)
+
+        self.link_uri = None
+        self.link_open = False
+        self.position = [0.0, 0.0, 0.0]
+        self.velocity = [0.0, 0.0, 0.0]
+        self.setpoint = None
+        self.variance = 1.0
+        self.scanning = False
+        self.scans = 0
+
+        self._lock = RLock()
+        self._log_configs: List[SimLogConfig] = []
+        self._console_backlog: List[str] = []
+        self._scan_history: List[Tuple[float, Tuple[float, float, float]]] = []
+        self._next_periodic_scan = None
+        self._first_connected = None
+        self._outage_until = None
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="sim-crazyflie", daemon=True)
+        self._thread.start()
+
+    # Link
+    def open_link(self, link_uri: str):
+        self.link_uri = link_uri
+        if self._outage_until is not None and self.clock.time() < self._outage_until:
+            self.clock.call_later(CONNECT_LATENCY, self.connection_failed.call, link_uri, "Simulated link outage")
+            return
+        self.clock.call_later(CONNECT_LATENCY, self._link_up, link_uri)
+
+    def _link_up(self, link_uri: str):
+        with self._lock:
+            if self.link_open or link_uri != self.link_uri:
+                return
+            self.link_open = True
+            if self._first_connected is None:
+                self._first_connected = self.clock.time()
+            backlog = "".join(self._console_backlog)
+            self._console_backlog = []
+        self.connected.call(link_uri)
+        self._send_console(backlog)
+        # Like cflib, all parameter values are read on connecting
+        for name in list(self.param.values):
+            self.param.notify(name)
+
+    def close_link(self):
+        with self._lock:
+            was_open = self.link_open
+            self.link_open = False
+            self.link_uri = None if not was_open else self.link_uri
+            # Log blocks do not survive the link
+            self._log_configs = []
+        self.disconnected.call(self.link_uri)
+
+    def drop_link(self):
+        # Simulates losing the link, e.g. out of range or a crashed radio, for link_outage seconds
+        with self._lock:
+            self.link_open = False
+            self._log_configs = []
+            self._outage_until = self.clock.time() + self.link_outage
+        self.connection_lost.call(self.link_uri, "Simulated link loss")
+
+    def stop(self):
+        self._stopped.set()
+
+    # Parameters and logging
+    def set_param(self, name: str, value: str):
+        with self._lock:
+            self.param.values[name] = value
+            if name in ('kalman.initialX', 'kalman.initialY', 'kalman.initialZ') and self.setpoint is None:
+                self.position['xyz'.index(name[-1].lower())] = float(value)
+            elif name == 'kalman.resetEstimation' and value == '1':
+                self.variance = 1.0
+            elif name == 'esp8266.scanNow' and value == '1' and not self.scanning:
+                self._start_scan()
+            elif name == 'esp8266.scanOnDemand':
+                self._next_periodic_scan = None if value == '1' else self.clock.time()
+            link_open = self.link_open
+        if link_open:
+            self.clock.call_later(PARAM_LATENCY, self.param.notify, name)
+
+    def add_log_config(self, log_config: SimLogConfig):
+        with self._lock:
+            self._log_configs.append(log_config)
+
+    def remove_log_config(self, log_config: SimLogConfig):
+        with self._lock:
+            if log_config in self._log_configs:
+                self._log_configs.remove(log_config)
+
+    def _log_value(self, variable: str) -> float:
+        group, name = variable.split('.', 1)
+        if group == 'stateEstimate':
+            axis = 'xyz'.index(name[-1])
+            if name.startswith('v'):
+                return self.velocity[axis]
+            return self.position[axis] + self.rng.gauss(0, POSITION_NOISE)
+        if group == 'kalman' and name.startswith('varP'):
+            return self.variance
+        return 0.0
+
+    # Console and ESP8266
+    def _send_console(self, text: str):
+        for start in range(0, len(text), PACKET_SIZE):
+            self.console.receivedChar.call(text[start:start + PACKET_SIZE])
+
+    def _print(self, text: str):
+        # Output is held back by the Crazyflie while there is no link
+        with self._lock:
+            if not self.link_open:
+                self._console_backlog.append(text)
+                return
+        self._send_console(text)
+
+    def _start_scan(self):
+        self.scanning = True
+        self.param.values['esp8266.scanNow'] = '1'
+        self._scan_history = [(self.clock.time(), tuple(self.position))]
+        x, y, z = self.position
+        self._print(f"AT+CWLAP\nPOS: x={x:.6f} y={y:.6f} z={z:.6f}\n")
+        duration = self.scan_duration + self.rng.uniform(-SCAN_JITTER, SCAN_JITTER)
+        self.clock.call_later(duration, self._finish_scan, duration)
+
+    def _position_during_scan(self, fraction: float):
+        start = self._scan_history[0][0]
+        end = self._scan_history[-1][0]
+        moment = start + fraction * (end - start)
+        return min(self._scan_history, key=lambda entry: abs(entry[0] - moment))[1]
+
+    def _finish_scan(self, duration: float):
+        with self._lock:
+            lines = ["ESP8266: -- START READING --"]
+            for ap in self.access_points:
+                position = self._position_during_scan((ap.channel - 0.5) / WIFI_CHANNELS)
+                rssi = ap.rssi(position, self.rng)
+                if rssi >= RSSI_CUTOFF:
+                    lines.append(f"AP: {ap.ssid}, {rssi}, {ap.mac}, {ap.channel}")
+            lines.append("ESP8266: -- STOP READING --")
+            # scanNow is cleared by the deck, cflib only learns about it when reading the parameter again
+            self.param.values['esp8266.scanNow'] = '0'
+            self.scanning = False
+            self.scans += 1
+        self._print("\n".join(lines) + "\n")
+
+    # Physics
+    def _step(self, dt: float, now: float):
+        with self._lock:
+            if self.setpoint is not None:
+                for axis in range(3):
+                    speed = (self.setpoint[axis] - self.position[axis]) / RESPONSE_TIME
+                    self.velocity[axis] = max(-MAX_SPEED, min(MAX_SPEED, speed))
+                    self.position[axis] += self.velocity[axis] * dt
+            else:
+                self.velocity = [0.0, 0.0, 0.0]
+
+            self.variance = VARIANCE_FLOOR + (self.variance - VARIANCE_FLOOR) * math.exp(-dt / VARIANCE_TIME_CONSTANT)
+
+            if self.scanning:
+                self._scan_history.append((now, tuple(self.position)))
+
+            if self._next_periodic_scan is not None and now >= self._next_periodic_scan and not self.scanning:
+                self._next_periodic_scan = now + float(self.param.values['esp8266.scanInterval'])
+                self._start_scan()
+
+            drop = self.link_open and self.link_drops and now - self._first_connected >= self.link_drops[0]
+            if drop:
+                self.link_drops.pop(0)
+
+            due = []
+            if self.link_open and not drop:
+                for log_config in self._log_configs:
+                    if log_config.started and now >= log_config.next_due:
+                        log_config.next_due = max(log_config.next_due + log_config.period_in_ms / 1000, now)
+                        due.append((log_config, {v: self._log_value(v) for v in log_config.variables}))
+
+        for log_config, data in due:
+            log_config.data_received_cb.call(int(now * 1000), data, log_config)
+        if drop:
+            logger.warning(f"Simulation: dropping the link of {self.link_uri}")
+            self.drop_link()
+
+    def _run(self):
+        last = self.clock.time()
+        while not self._stopped.is_set():
+            self.clock.sleep(PHYSICS_STEP)
+            now = self.clock.time()
+            self._step(now - last, now)
+            last = now
+
+
+# Backend for ScanningDrone and FleetRunner that flies simulated Crazyflies, speed times faster than real time
+class SimulatedBackend:
+    def __init__(self, speed: float = 100.0, access_points: Optional[List[SimulatedAccessPoint]] = None,
+                 seed: int = 0, scan_duration: float = SCAN_DURATION, link_drops: Sequence[float] = ()):
+        self.clock = ScaledClock(speed)
+        self.link_drops = link_drops
+        self.access_points = access_points if access_points is not None else random_access_points(seed=seed)
+        self.scan_duration = scan_duration
+        self._rng = random.Random(seed)
+        self.crazyflies: List[SimulatedCrazyflie] = []
+
+    def create_crazyflie(self) -> SimulatedCrazyflie:
+        cf = SimulatedCrazyflie(self.clock, self.access_points, random.Random(self._rng.random()), self.scan_duration,
+                                self.link_drops)
+        self.crazyflies.append(cf)
+        return cf
+
+    def log_config(self, name: str, period_in_ms: int) -> SimLogConfig:
+        return SimLogConfig(name, period_in_ms)
+
+    def toc_cache_hit(self, cf) -> Optional[bool]:
+        # Simulated Crazyflies have no TOC to download
+        return None
+
+    def prepare_cache(self) -> dict:
+        return {'valid': 0, 'removed': 0}
+
+    def close_link_driver(self, link_uri: str):
+        pass
+
+    def power_down(self, link_uri: str):
+        for cf in self.crazyflies:
+            if cf.link_uri == link_uri:
+                cf.stop()
+
+
+def main(argv=None):
+    # Imported here, the planner and fleet are not needed to use the simulated backend on its own
+    from .adaptive import load_measurements, plan_adaptive_drones
+    from .aggregate import VoxelAggregator
+    from .fleet import HOVER, MODES, FleetRunner
+    from .live import LiveServer
+    from .metrics import MetricsServer
+    from .planner import plan_drones
+
+    parser = argparse.ArgumentParser(description="Fly a planned mission against simulated Crazyflies")
+    parser.add_argument('--speed', type=float, default=100.0, help="how many times faster than real time to run")
+    parser.add_argument('--drones', type=int, default=len(SIM_STARTS), help="number of drones")
+    parser.add_argument('--resolution', type=float, default=0.5, help="scan grid spacing in meters")
+    parser.add_argument('--output', default="output", help="directory for the measurement files")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drop-link', type=float, action='append', default=[], metavar='SECONDS',
+                        help="lose the link of every drone this many seconds after connecting (can be repeated)")
+    parser.add_argument('--checkpoint-dir', default=None, help="save the progress of every drone in this directory")
+    parser.add_argument('--resume', action='store_true', help="skip the waypoints scanned according to the checkpoints")
+    parser.add_argument('--live', type=int, default=None, metavar='PORT',
+                        help="publish the mission on http://127.0.0.1:PORT/events")
+    parser.add_argument('--metrics-file', default=None, help="write the mission metrics (JSON) to this file")
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help="serve the mission metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--mode', choices=MODES, default=HOVER,
+                        help="scan while hovering at every waypoint, or while flying the waypoints as one path")
+    parser.add_argument('--adaptive', type=float, default=None, metavar='SECONDS',
+                        help="after the grid pass, fly a second pass of at most SECONDS per drone that scans where "
+                             "the map is most uncertain")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.INFO)
+
+    drones = [
+        {
+            "uri": f"sim://0/80/2M/E7E7E7E7{i:02X}",
+            "start_x": SIM_STARTS[i % len(SIM_STARTS)][0] if i < len(SIM_STARTS) else 0.3 + 0.5 * i,
+            "start_y": SIM_STARTS[i % len(SIM_STARTS)][1],
+            "start_z": SIM_STARTS[i % len(SIM_STARTS)][2],
+            "start_yaw": SIM_STARTS[i % len(SIM_STARTS)][3],
+        }
+        for i in range(args.drones)
+    ]
+    plan_drones(drones, SIM_VOLUME, args.resolution)
+
+    os.makedirs(args.output, exist_ok=True)
+    backend = SimulatedBackend(args.speed, seed=args.seed, link_drops=args.drop_link)
+    live = None
+    aggregator = None
+    if args.live is not None:
+        aggregator = VoxelAggregator()
+        live = LiveServer(args.live, aggregator)
+        live.start()
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(args.metrics_port)
+        metrics_server.start()
+    runner = FleetRunner(drones, backend=backend, output_dir=args.output, aggregator=aggregator, live=live,
+                         checkpoint_dir=args.checkpoint_dir, resume=args.resume, metrics_file=args.metrics_file,
+                         mode=args.mode)
+    launched = backend.clock.time()
+    try:
+        runner.run()
+        if args.adaptive is not None:
+            filenames = [f for run in runner.runs if run.drone is not None and run.drone.writer is not None
+                         for f in run.drone.writer.filenames]
+            plan_adaptive_drones(drones, load_measurements(filenames), SIM_VOLUME, args.adaptive)
+            runner = FleetRunner(drones, backend=backend, output_dir=args.output, aggregator=aggregator, live=live,
+                                 metrics_file=args.metrics_file, mode=args.mode)
+            runner.run()
+    finally:
+        if live is not None:
+            live.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+    simulated = runner.finished - launched
+    logger.info(f"Simulated {simulated:.1f}s of flight in {simulated / args.speed:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
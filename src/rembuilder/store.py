@@ -0,0 +1,131 @@
+from array import array
+from datetime import datetime, timedelta
+import logging
+
+from typing import Dict, Iterable, Iterator, List
+
+from .utils import Measurement, normalize_rssi, obfuscate_mac
+
+logger = logging.getLogger("rembuilder")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class StringTable:
+    # Interns strings into consecutive integer ids, the same SSIDs and MACs show up in every scan
+    def __init__(self):
+        self.strings: List[str] = []
+        self.ids: Dict[str, int] = {}
+
+    def intern(self, value: str) -> int:
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self.ids[value] = string_id
+        return string_id
+
+    def __getitem__(self, string_id: int) -> str:
+        return self.strings[string_id]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+# Append-only, column oriented storage for measurements. Timestamps are kept as microseconds since the (naive) epoch,
+# positions as doubles and SSID/MAC as ids into a StringTable. Rows are turned back into Measurement objects on
+# access, so str()/repr() output and get_mac() obfuscation stay identical to the ones of Measurement.
+class MeasurementStore:
+    COLUMNS = ('time', 'x', 'y', 'z', 'ssid', 'rssi', 'mac', 'chn')
+
+    def __init__(self):
+        self.ssids = StringTable()
+        self.macs = StringTable()
+
+        self.time = array('q')
+        self.x = array('d')
+        self.y = array('d')
+        self.z = array('d')
+        self.ssid = array('I')
+        self.rssi = array('b')
+        self.mac = array('I')
+        self.chn = array('B')
+
+    def append_row(self, timestamp: datetime, x: float, y: float, z: float, ssid: str, rssi: int, mac: str,
+                   chn: int):
+        self.time.append((timestamp - EPOCH) // timedelta(microseconds=1))
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+        self.ssid.append(self.ssids.intern(ssid))
+        self.rssi.append(rssi)
+        self.mac.append(self.macs.intern(str(mac).rjust(12, '0')))
+        self.chn.append(chn)
+
+    def append(self, measurement: Measurement):
+        self.append_row(measurement.timestamp, measurement.x, measurement.y, measurement.z, measurement.ssid,
+                        measurement.rssi, measurement.mac, measurement.chn)
+
+    def extend(self, measurements: Iterable[Measurement]):
+        for measurement in measurements:
+            self.append(measurement)
+
+    # Can be registered directly as a ConsolePrinter scan listener
+    append_scan = extend
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, row: int) -> Measurement:
+        return Measurement(
+            self.get_timestamp(row),
+            x=self.x[row],
+            y=self.y[row],
+            z=self.z[row],
+            ssid=self.ssids[self.ssid[row]],
+            rssi=self.rssi[row],
+            mac=self.macs[self.mac[row]],
+            chn=self.chn[row]
+        )
+
+    def __iter__(self) -> Iterator[Measurement]:
+        for row in range(len(self)):
+            yield self[row]
+
+    def get_timestamp(self, row: int) -> datetime:
+        return EPOCH + timedelta(microseconds=self.time[row])
+
+    def get_mac(self, row: int) -> str:
+        mac = self.macs[self.mac[row]]
+        return obfuscate_mac(mac) if Measurement.obfuscate_mac_address else mac
+
+    def normalized_signal_strength(self, row: int) -> float:
+        return normalize_rssi(self.rssi[row])
+
+    def rows_for_mac(self, mac: str) -> List[int]:
+        mac_id = self.macs.ids.get(str(mac).rjust(12, '0'))
+        if mac_id is None:
+            return []
+        return [row for row, value in enumerate(self.mac) if value == mac_id]
+
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in (getattr(self, name) for name in self.COLUMNS))
+
+    @classmethod
+    def load(cls, filename: str) -> 'MeasurementStore':
+        # Reads back a semicolon delimited *_rembuilder.out file as written by MeasurementWriter
+        store = cls()
+        with open(filename) as fh:
+            header = fh.readline()
+            if not header.startswith("time;"):
+                raise ValueError(f"{filename} is not a measurement file")
+            for line in fh:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                # The SSID may itself contain semicolons, everything else is fixed width
+                timestamp, x, y, z, rest = line.split(';', 4)
+                ssid, rssi, mac, chn = rest.rsplit(';', 3)
+                store.append_row(datetime.fromisoformat(timestamp), float(x), float(y), float(z), ssid, int(rssi),
+                                 mac, int(chn))
+        return store
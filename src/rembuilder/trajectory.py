@@ -0,0 +1,50 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import List, Optional, Tuple
+
+MAX_SAMPLES = 6000  # Number of state estimate samples kept, 5 minutes at the default 50ms log period
+MAX_GAP = 0.5  # Number of seconds between samples (or beyond the ends) over which no position is interpolated
+
+
+# Time-stamped positions from the state estimate log, used to find where the drone was at any moment in the recent
+# past. Timestamps are the clock.time() values (see clock.py) of the drone's backend at which the samples were received,
+# host time.monotonic() in flight and the scaled simulated time in sim.py.
+class TrajectoryLog:
+    def __init__(self, max_samples: int = MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._times: List[float] = []
+        self._positions: List[Tuple[float, float, float]] = []
+        self._lock = Lock()
+
+    def append(self, timestamp: float, x: float, y: float, z: float):
+        with self._lock:
+            if self._times and timestamp < self._times[-1]:
+                return
+            self._times.append(timestamp)
+            self._positions.append((x, y, z))
+            # Trimming in bulk keeps appends amortized O(1)
+            if len(self._times) > 2 * self.max_samples:
+                del self._times[:-self.max_samples]
+                del self._positions[:-self.max_samples]
+
+    def __len__(self):
+        return len(self._times)
+
+    def position_at(self, timestamp: float) -> Optional[Tuple[float, float, float]]:
+        with self._lock:
+            index = bisect_left(self._times, timestamp)
+            if index < len(self._times) and self._times[index] == timestamp:
+                return self._positions[index]
+            if index == 0 or index == len(self._times):
+                # Outside of the log, only a sample close enough in time will do
+                nearest = 0 if index == 0 else index - 1
+                if not self._times or abs(self._times[nearest] - timestamp) > MAX_GAP:
+                    return None
+                return self._positions[nearest]
+
+            t0, t1 = self._times[index - 1], self._times[index]
+            if t1 - t0 > MAX_GAP:
+                return None
+            fraction = (timestamp - t0) / (t1 - t0)
+            p0, p1 = self._positions[index - 1], self._positions[index]
+            return tuple(a + (b - a) * fraction for a, b in zip(p0, p1))
@@ -3,8 +3,10 @@ import logging
 import re
 import time
 
-from threading import Thread, Lock
-from typing import List
+from threading import Thread, Condition
+from typing import Callable, List, Optional, Tuple
+
+from .clock import SYSTEM_CLOCK
 
 # Regexes for parsing output
 PTN_CWLAP = re.compile(r'^AT\+CWLAP(=\d*,\d*,\d*,\d*,\d*,\d*)?$')
@@ -14,10 +16,24 @@ PTN_AP = re.compile(r'^AP: (?P<ssid>.*), (?P<rssi>-?\d+), (?P<mac>\w+), (?P<chn>
 PTN_END = re.compile(r'^ESP8266: -- STOP READING --$')
 # PTN_POS = re.compile(r'^POS: (?:[xyz]=([+-]?\d+\.\d+)\s){3}$')
 
+WIFI_CHANNELS = 13  # The ESP8266 sweeps the 2.4GHz channels in order, so the channel tells when in a scan an AP was seen
+
 logger = logging.getLogger("rembuilder")
 
 
+def normalize_rssi(rssi):
+    # 802.11 rssi from -10 (strongest) to -100 (weakest), normalized to a value in the interval [0, 1], closer
+    # to one means a stronger signal. Works on plain numbers as well as on numpy arrays.
+    return (rssi + 100) / 90
+
+
+def obfuscate_mac(mac: str) -> str:
+    return mac[:6] + 6 * '-'
+
+
 class Measurement:
+    __slots__ = ('timestamp', 'x', 'y', 'z', 'ssid', 'rssi', 'mac', 'chn')
+
     obfuscate_mac_address = False
 
     def __init__(self, timestamp: datetime, x: float, y: float, z: float, ssid: str, rssi: int, mac: str, chn: int):
@@ -31,13 +47,11 @@ class Measurement:
         self.chn = int(chn)
 
     def normalized_signal_strength(self) -> float:
-        # 802.11 rssi from -10 (strongest) to -100 (weakest), normalized to a value in the interval [0, 1], closer
-        # to one means a stronger signal
-        return (self.rssi + 100) / 90
+        return normalize_rssi(self.rssi)
 
     def get_mac(self) -> str:
         if Measurement.obfuscate_mac_address:
-            return self.mac[:6] + 6 * '-'
+            return obfuscate_mac(self.mac)
         else:
             return self.mac
 
@@ -46,19 +60,15 @@ class Measurement:
                f"{self.ssid};{self.rssi};{self.get_mac()};{self.chn}"
 
 
-class ConsolePrinter(Thread):
-    def __init__(self, console):
-        super().__init__()
-
-        self.buffer = ""
-        self.buffer_lock = Lock()
-        self.stop = False
+# The CWLAP -> POS -> BEGIN -> AP -> END state machine of the ESP8266 deck output. parse_line returns the measurements
+# of a scan once its closing line has been parsed, and None otherwise. The time of a scan is the time its CWLAP line
+# was parsed, or the now given with that line when re-parsing logged console output.
+class ScanParser:
+    def __init__(self, clock=SYSTEM_CLOCK):
+        self.clock = clock
         self.ap_list: List[Measurement] = []
         self.last_parsed_position = (None, None, None)
 
-        # Register callbacks
-        console.receivedChar.add_callback(self.cb_append_to_console)
-
         # Matching status
         self.reading_phase = False
         self.pos_known_phase = False
@@ -66,45 +76,18 @@ class ConsolePrinter(Thread):
 
         # Match tracking
         self.cwlap_start_time = None
+        self.cwlap_start_monotonic = None
         self.cwlap_result_count = 0
+        self.scan_duration = None  # Seconds from CWLAP to the end of the last completed scan
 
-    def cb_append_to_console(self, text):
-        with self.buffer_lock:
-            self.buffer += text
-
-    def run(self) -> None:
-        while not self.stop:
-            while 1:
-                with self.buffer_lock:
-                    pos = self.buffer.find('\n')
-                    if pos < 0:
-                        break
-                    line = self.buffer[:pos].rstrip('\r\n')
-                    logger.debug(f'CF: {line}')
-                    self.buffer = self.buffer[pos+1:]
-                    self.parse_line(line)
-            time.sleep(0.2)
-
-        # Write results to file
-        logger.info(f"Collected {len(self.ap_list)} measurements. Writing to file...")
-        filename = datetime.now().strftime('%Y%m%d_%H%M%S') + "_rembuilder.out"
-        with open("output/" + filename, 'w') as fh:
-            fh.write("time;x;y;z;ssid;rssi;mac;channel\n")
-            for ap in self.ap_list:
-                fh.write(str(ap) + '\n')
-        logger.info(f"Results written to {filename}")
-
-        for ap in self.ap_list:
-            # print(*ap, flush=True)
-            logger.debug(ap)
-
-    def parse_line(self, line):
+    def parse_line(self, line: str, now: Optional[datetime] = None) -> Optional[List[Measurement]]:
         if not self.cwlap_phase:
             mo = PTN_CWLAP.match(line)
             if mo is not None:
                 logger.debug("REGEX: self.cwlap_phase = True")
                 self.cwlap_phase = True
-                self.cwlap_start_time = datetime.utcnow()
+                self.cwlap_start_time = now if now is not None else datetime.utcnow()
+                self.cwlap_start_monotonic = self.clock.time()
                 self.cwlap_result_count = 0
         elif not self.pos_known_phase:
             mo = PTN_POS.match(line)
@@ -139,9 +122,156 @@ class ConsolePrinter(Thread):
                 mo = PTN_END.match(line)
                 if mo is not None:
                     logger.debug("REGEX: self.cwlap_phase = False")
-                    logger.info(f"{self.cwlap_result_count} access points found")
+                    if now is not None:
+                        self.scan_duration = (now - self.cwlap_start_time).total_seconds()
+                    else:
+                        self.scan_duration = self.clock.time() - self.cwlap_start_monotonic
+                    scan = self.ap_list
+                    self.ap_list = []
                     self.cwlap_phase = False
                     self.pos_known_phase = False
                     self.reading_phase = False
                     self.cwlap_start_time = None
                     self.cwlap_result_count = 0
+                    return scan
+        return None
+
+
+class ConsolePrinter(Thread):
+    def __init__(self, console, sink=None, clock=SYSTEM_CLOCK, tag: Optional[str] = None):
+        super().__init__()
+        self.clock = clock
+        # Console lines are logged as "CF[<tag>]: <line>", so the output of several drones logged to the same file can
+        # be told apart again (see extract.py)
+        self.tag = tag
+        self._log_prefix = f"CF[{tag}]: " if tag else "CF: "
+
+        # Incoming console text is kept as a list of chunks, the consumer swaps the whole list out at once so the
+        # callback thread never has to wait for parsing
+        self._chunks: List[str] = []
+        self._partial_line = ""
+        self.buffer_lock = Condition()
+        self._stop_requested = False
+
+        # Measurements of the scan currently being read are kept by the parser, and handed to the scan listeners (e.g.
+        # the output writer) once the scan is complete, so memory use does not grow with the length of the mission
+        self.parser = ScanParser(clock)
+        self.measurement_count = 0
+        self.scan_count = 0
+        self.sink = sink
+        self.scan_listeners: List[Callable[[List[Measurement]], None]] = []
+        self.scan_duration_listeners: List[Callable[[float], None]] = []
+        if sink is not None:
+            self.scan_listeners.append(sink.write_scan)
+
+        # When set, the position of every AP is looked up for the moment (clock.time()) it was seen instead of taken
+        # from the POS line, for scans taken while moving
+        self.position_source: Optional[Callable[[float], Optional[Tuple[float, float, float]]]] = None
+
+        # Register callbacks
+        console.receivedChar.add_callback(self.cb_append_to_console)
+
+        # Throughput tracking
+        self.chars_received = 0
+        self.chunks_received = 0
+        self.lines_parsed = 0
+        self.parse_time = 0.0
+        self.start_time = None
+
+    @property
+    def stop(self) -> bool:
+        return self._stop_requested
+
+    @stop.setter
+    def stop(self, value: bool):
+        with self.buffer_lock:
+            self._stop_requested = value
+            self.buffer_lock.notify()
+
+    def cb_append_to_console(self, text):
+        with self.buffer_lock:
+            self._chunks.append(text)
+            self.chars_received += len(text)
+            self.chunks_received += 1
+            self.buffer_lock.notify()
+
+    def _take_chunks(self) -> List[str]:
+        with self.buffer_lock:
+            while not self._chunks and not self._stop_requested:
+                self.buffer_lock.wait()
+            chunks = self._chunks
+            self._chunks = []
+        return chunks
+
+    def _process_chunks(self, chunks: List[str]):
+        # Only the text after the last newline is carried over, so every character is scanned a constant number of
+        # times regardless of how the console splits its output
+        text = self._partial_line + "".join(chunks)
+        lines = text.split('\n')
+        self._partial_line = lines.pop()
+
+        start = time.perf_counter()
+        for line in lines:
+            line = line.rstrip('\r')
+            logger.debug(f'{self._log_prefix}{line}')
+            self.parse_line(line)
+        self.parse_time += time.perf_counter() - start
+        self.lines_parsed += len(lines)
+
+    def throughput(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        return {
+            'chars': self.chars_received,
+            'chunks': self.chunks_received,
+            'lines': self.lines_parsed,
+            'elapsed': elapsed,
+            'chars_per_second': self.chars_received / elapsed if elapsed > 0 else 0.0,
+            'lines_per_second': self.lines_parsed / elapsed if elapsed > 0 else 0.0,
+            'parse_lines_per_second': self.lines_parsed / self.parse_time if self.parse_time > 0 else 0.0,
+        }
+
+    def run(self) -> None:
+        self.start_time = time.perf_counter()
+        while True:
+            chunks = self._take_chunks()
+            if chunks:
+                self._process_chunks(chunks)
+            elif self._stop_requested:
+                break
+
+        stats = self.throughput()
+        logger.info(f"Console: {stats['lines']} lines ({stats['chars']} chars in {stats['chunks']} chunks) in "
+                    f"{stats['elapsed']:.1f}s, parsing at {stats['parse_lines_per_second']:.0f} lines/s")
+
+        if self.sink is not None:
+            self.sink.close()
+        logger.info(f"Collected {self.measurement_count} measurements in {self.scan_count} scans")
+
+    def _interpolate_positions(self, scan: List[Measurement], start: float, duration: float):
+        for measurement in scan:
+            fraction = (min(max(measurement.chn, 1), WIFI_CHANNELS) - 0.5) / WIFI_CHANNELS
+            position = self.position_source(start + fraction * duration)
+            if position is not None:
+                measurement.x, measurement.y, measurement.z = position
+
+    def _complete_scan(self, scan: List[Measurement]):
+        logger.info(f"{len(scan)} access points found")
+        duration = self.parser.scan_duration
+        if self.position_source is not None:
+            self._interpolate_positions(scan, self.parser.cwlap_start_monotonic, duration)
+
+        self.scan_count += 1
+        self.measurement_count += len(scan)
+        for listener in self.scan_listeners:
+            try:
+                listener(scan)
+            except Exception:
+                logger.exception("Scan listener failed")
+
+        for listener in self.scan_duration_listeners:
+            listener(duration)
+
+    def parse_line(self, line):
+        scan = self.parser.parse_line(line)
+        if scan is not None:
+            self._complete_scan(scan)
@@ -0,0 +1,110 @@
+from datetime import datetime
+import logging
+import os
+import time
+
+from threading import Lock
+from typing import List, Optional
+
+from .metrics import METRICS
+
+logger = logging.getLogger("rembuilder")
+
+HEADER = "time;x;y;z;ssid;rssi;mac;channel\n"
+MAX_FILE_SIZE = 64 * 1024 * 1024  # Start a new output file once the current one grows beyond this many bytes
+
+
+# Appends completed scans to <directory>/<timestamp>[_<tag>]_rembuilder.out as they come in. Scans are batched in
+# memory until batch_scans of them are pending, then written and flushed. With fsync set the data is also forced to
+# disk on every write, so a crash loses at most one batch. Files are rotated once they grow beyond max_bytes.
+class MeasurementWriter:
+    def __init__(self, directory: str = "output", tag: Optional[str] = None, batch_scans: int = 1,
+                 fsync: bool = False, max_bytes: int = MAX_FILE_SIZE, metrics=METRICS):
+        self.directory = directory
+        self._metrics = metrics
+        self._labels = {'writer': tag or ""}
+        self.batch_scans = max(1, batch_scans)
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+
+        self._base_name = datetime.now().strftime('%Y%m%d_%H%M%S') + (f"_{tag}" if tag else "")
+        self._lock = Lock()
+        self._pending: List[str] = []
+        self._pending_scans = 0
+        self._fh = None
+        self._file_size = 0
+        self._file_index = 0
+
+        self.filenames: List[str] = []
+        self.measurement_count = 0
+        self.scan_count = 0
+
+    def _next_filename(self) -> str:
+        suffix = f"_{self._file_index:03d}" if self._file_index else ""
+        self._file_index += 1
+        return os.path.join(self.directory, f"{self._base_name}_rembuilder{suffix}.out")
+
+    def _open(self):
+        filename = self._next_filename()
+        self._fh = open(filename, 'w')
+        self._fh.write(HEADER)
+        self._file_size = len(HEADER)
+        self.filenames.append(filename)
+        logger.info(f"Writing results to {filename}")
+
+    def _rotate(self):
+        self._close_file()
+        self._open()
+
+    def _close_file(self):
+        if self._fh is not None:
+            self._sync()
+            self._fh.close()
+            self._fh = None
+
+    def _sync(self):
+        self._fh.flush()
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+
+    def write_scan(self, measurements):
+        if not measurements:
+            return
+
+        with self._lock:
+            self._pending.append("".join(str(m) + '\n' for m in measurements))
+            self._pending_scans += 1
+            self.scan_count += 1
+            self.measurement_count += len(measurements)
+            if self._pending_scans >= self.batch_scans:
+                self._write_pending()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+
+        if self._fh is None:
+            self._open()
+        elif self._file_size >= self.max_bytes:
+            self._rotate()
+
+        data = "".join(self._pending)
+        started = time.perf_counter()
+        before = self._file_size
+        self._fh.write(data)
+        self._sync()
+        # In bytes, SSIDs may hold multi-byte characters
+        self._file_size = self._fh.tell()
+        self._metrics.observe('write_seconds', time.perf_counter() - started, **self._labels)
+        self._metrics.inc('bytes_written_total', self._file_size - before, **self._labels)
+        self._pending = []
+        self._pending_scans = 0
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def close(self):
+        with self._lock:
+            self._write_pending()
+            self._close_file()